@@ -0,0 +1,251 @@
+"""
+End-to-end benchmarks of `postcodes.PostCoder` against a local
+stand-in for the web-service, with configurable latency and payload
+size. Run from the repository root with::
+
+    $ python -m benchmarks.bench_postcoder --output results.json
+
+Each workload reports its throughput, p50/p99/mean latency in seconds
+and peak memory allocated, as JSON. Given the results of an earlier run
+with ``--baseline``, the exit status is non-zero if any workload's
+throughput fell, or p99 latency rose, by more than ``--tolerance``.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import postcodes
+from postcodes import PostCoder, Transport
+
+from tests.server import StubServer
+
+WORKLOADS = ('serial', 'serial-nearest', 'serial-radius', 'threaded',
+             'batch', 'cached')
+
+
+def make_postcodes(count, seed=0):
+    """
+    Makes `count` distinct, valid postcodes at random points around
+    London.
+    """
+    rnd = random.Random(seed)
+    result = {}
+    for i in range(count):
+        postcode = 'B%s%d%d%s%s' % (chr(65 + i // 1000 % 26),
+                                    i // 10 % 100, i % 10,
+                                    chr(65 + rnd.randrange(26)),
+                                    chr(65 + rnd.randrange(26)))
+        result[postcode] = (51.5 + rnd.uniform(-0.1, 0.1),
+                            -0.12 + rnd.uniform(-0.15, 0.15))
+    return result
+
+
+def percentile(values, pct):
+    """ The nearest-rank `pct` percentile of sorted `values`. """
+    if not values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def timed(fun, latencies):
+    """ Calls `fun`, appending how long it took to `latencies`. """
+    start = time.time()
+    fun()
+    latencies.append(time.time() - start)
+
+
+def workload(name, coder, points, options):
+    """
+    Returns a function which runs workload `name` over `points`,
+    appending the latency of each operation to a list.
+    """
+    keys = sorted(points)
+
+    def serial(latencies):
+        for postcode in keys:
+            timed(lambda: coder.get(postcode, skip_cache=True), latencies)
+
+    def serial_nearest(latencies):
+        for postcode in keys:
+            lat, lng = points[postcode]
+            timed(lambda: coder.get_nearest(lat, lng, skip_cache=True),
+                  latencies)
+
+    def serial_radius(latencies):
+        for postcode in keys[:max(len(keys) // 10, 1)]:
+            lat, lng = points[postcode]
+            timed(lambda: coder.get_from_geo(lat, lng, options.radius,
+                                             skip_cache=True), latencies)
+
+    def threaded(latencies):
+        def worker(chunk):
+            for postcode in chunk:
+                timed(lambda: coder.get(postcode, skip_cache=True),
+                      latencies)
+        threads = [threading.Thread(target=worker,
+                                    args=(keys[i::options.workers],))
+                   for i in range(options.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def batch(latencies):
+        # the results of get_many arrive together, so time its requests
+        coder.cache.clear()
+        coder.negative_cache.clear()
+        metrics = postcodes.enable_metrics()
+        metrics.add_hook(lambda kind, name, value: kind == 'observe' and
+                         name.startswith('latency.') and
+                         latencies.append(value))
+        try:
+            for _ in coder.get_many(keys, max_workers=options.workers):
+                pass
+        finally:
+            postcodes.disable_metrics()
+
+    if name == 'cached':
+        for postcode in keys:
+            coder.get(postcode)
+
+    def cached(latencies):
+        for postcode in keys:
+            timed(lambda: coder.get(postcode), latencies)
+
+    return {'serial': serial, 'serial-nearest': serial_nearest,
+            'serial-radius': serial_radius, 'threaded': threaded,
+            'batch': batch, 'cached': cached}[name]
+
+
+def measure(run, repeat):
+    """
+    Runs `run` `repeat` times, returning its throughput and latencies,
+    and then once more with allocations traced for its peak memory.
+    """
+    latencies, elapsed = [], 0.0
+    for _ in range(repeat):
+        start = time.time()
+        run(latencies)
+        elapsed += time.time() - start
+    latencies.sort()
+    result = {
+        'operations': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'peak_memory': None,
+    }
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            run([])
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run(options):
+    points = make_postcodes(options.postcodes)
+    server = StubServer(points, latency=options.latency,
+                        padding=options.payload).start()
+    transport = Transport(pool_size=options.workers)
+    saved, postcodes.END_POINT = postcodes.END_POINT, server.url
+    try:
+        results = {}
+        for name in options.workloads:
+            coder = PostCoder(transport=transport)
+            results[name] = measure(workload(name, coder, points, options),
+                                    options.repeat)
+    finally:
+        postcodes.END_POINT = saved
+        transport.close()
+        server.stop()
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict((k, getattr(options, k)) for k in
+                           ('postcodes', 'latency', 'payload', 'workers',
+                            'radius', 'repeat')),
+        'results': results,
+    }
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Lists the workloads in `report` whose throughput or p99 latency is
+    more than `tolerance` worse than in `baseline`.
+    """
+    found = []
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if before['throughput'] and result['throughput'] is not None and \
+                result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append('%s: throughput %.1f/s, was %.1f/s' %
+                         (name, result['throughput'], before['throughput']))
+        if before['p99'] and result['p99'] is not None and \
+                result['p99'] > before['p99'] * (1 + tolerance):
+            found.append('%s: p99 %.6fs, was %.6fs' %
+                         (name, result['p99'], before['p99']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--postcodes', type=int, default=500,
+                        help='number of postcodes to look up')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server delays each response')
+    parser.add_argument('--payload', type=int, default=0,
+                        help='bytes of padding added to each record')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads for the threaded and batch workloads')
+    parser.add_argument('--radius', type=float, default=1,
+                        help='miles searched by the radius workload')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times to run each workload')
+    parser.add_argument('--workload', dest='workloads', action='append',
+                        choices=WORKLOADS,
+                        help='workload to run; may be given several times '
+                             '(default: all)')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction worse than the baseline allowed')
+    options = parser.parse_args(argv)
+    options.workloads = options.workloads or list(WORKLOADS)
+
+    report = run(options)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if options.baseline:
+        with open(options.baseline) as f:
+            found = regressions(report, json.load(f), options.tolerance)
+        for regression in found:
+            sys.stderr.write('regression: %s\n' % regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
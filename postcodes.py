@@ -1,39 +1,944 @@
-import json
+import array
+import bisect
+import codecs
+import errno
+import heapq
+import math
+import os
+import struct
 import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
 
-if sys.version_info.major < 3:
-    from urllib2 import quote, URLError, urlopen
-else:
-    from urllib.error import URLError
-    from urllib.parse import quote
-    from urllib.request import urlopen
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# the HTTP client and URL handling modules are slow to import, so that 
+# `_import_http` imports them when they're first needed
+socket = HTTPConnection = HTTPSConnection = HTTPException = None
+RemoteDisconnected = quote = urljoin = urlsplit = None
+
+def _import_http():
+    global socket, HTTPConnection, HTTPSConnection, HTTPException, \
+           RemoteDisconnected, quote, urljoin, urlsplit
+    import socket
+    if sys.version_info.major < 3:
+        from httplib import HTTPConnection, HTTPSConnection, \
+                            HTTPException, BadStatusLine as RemoteDisconnected
+        from urllib2 import quote
+        from urlparse import urljoin, urlsplit
+    else:
+        from http.client import HTTPConnection, HTTPSConnection, \
+                                HTTPException, RemoteDisconnected
+        from urllib.parse import quote, urljoin, urlsplit
+
+def _environment_proxies():
+    """ 
+    Returns the proxies configured by the environment, as a dict of 
+    URL schemes to proxy URLs, and a function which reports whether a 
+    host should bypass them.
+    """
+    if sys.version_info.major < 3:
+        from urllib import getproxies, proxy_bypass
+    else:
+        from urllib.request import getproxies, proxy_bypass
+    return getproxies(), proxy_bypass
 
 END_POINT = 'http://www.uk-postcodes.com'
 
-def _get_json_resp(url):
-    try:
-        resp = urlopen(url)
-    except URLError as e:
-        if e.code == 404: # no available data   
+_MISSING = object()
+_now = getattr(time, 'monotonic', time.time)
+_sleep = time.sleep
+
+class Metrics(object):
+    """
+    Collects measurements from the library's hot paths, once enabled 
+    with `enable_metrics`:
+
+    * ``latency.<endpoint>`` and ``decode.<endpoint>`` histograms of the 
+      seconds spent requesting and decoding responses from each 
+      endpoint (``postcode``, ``latlng`` and ``distance.php``);
+    * ``bytes.<endpoint>`` counters of response bytes received;
+    * ``inflight.<endpoint>`` gauges of requests in progress;
+    * ``cache.hits``, ``cache.misses``, ``cache.negative_hits``, 
+      ``cache.nearest_hits`` and ``cache.evictions`` counters;
+    * ``transport.<outcome>`` counters mirroring `Transport.stats`;
+    * ``prefetch.requests``, ``prefetch.records`` and 
+      ``prefetch.dropped`` counters of `PostCoder` prefetches, the 
+      postcodes they cached and the prefetches skipped because 
+      `PostCoder.PREFETCH_WORKERS` were already running.
+
+    Hooks added with `add_hook` are called with the kind of each 
+    measurement (``'count'``, ``'gauge'`` or ``'observe'``), its name 
+    and its value, so measurements can be forwarded elsewhere.
+
+    :param buckets: upper bounds of the histograms' buckets.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters, self._gauges, self._histograms = {}, {}, {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ Calls ``hook(kind, name, value)`` for every measurement. """
+        self._hooks.append(hook)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for hook in self._hooks:
+            hook('count', name, value)
+
+    def gauge(self, name, delta):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+        for hook in self._hooks:
+            hook('gauge', name, delta)
+
+    def observe(self, name, value):
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = {
+                    'count': 0, 'sum': 0.0, 'min': value, 'max': value, 
+                    'buckets': [0] * (len(self.buckets) + 1)}
+            hist['count'] += 1
+            hist['sum'] += value
+            hist['min'] = min(hist['min'], value)
+            hist['max'] = max(hist['max'], value)
+            hist['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+        for hook in self._hooks:
+            hook('observe', name, value)
+
+    def snapshot(self):
+        """
+        Returns a dict of all the measurements so far, with 
+        ``counters``, ``gauges`` and ``histograms``. Each histogram has 
+        its ``count``, ``sum``, ``min`` and ``max``, and cumulative 
+        ``buckets`` as a list of (upper bound, count) tuples.
+        """
+        with self._lock:
+            histograms = {}
+            for name, hist in self._histograms.items():
+                bounds = self.buckets + (float('inf'),)
+                cumulative, total = [], 0
+                for bound, count in zip(bounds, hist['buckets']):
+                    total += count
+                    cumulative.append((bound, total))
+                histograms[name] = dict(hist, buckets=cumulative)
+            return {'counters': dict(self._counters), 
+                    'gauges': dict(self._gauges), 
+                    'histograms': histograms}
+
+    def reset(self):
+        """ Discards all measurements. """
+        with self._lock:
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+
+
+_metrics = None
+
+def enable_metrics(metrics=None):
+    """
+    Starts collecting measurements, into `metrics` if given or a new 
+    `Metrics` otherwise, and returns the `Metrics`. Until this is 
+    called, measuring costs next to nothing.
+    """
+    global _metrics
+    _metrics = Metrics() if metrics is None else metrics
+    return _metrics
+
+def disable_metrics():
+    """ Stops collecting measurements. """
+    global _metrics
+    _metrics = None
+
+def _endpoint(url):
+    """ Names the web-service endpoint `url` is for. """
+    if urlsplit is None:
+        _import_http()
+    path = urlsplit(url).path
+    if path.startswith('/postcode/'):
+        return 'postcode'
+    if path.startswith('/latlng/'):
+        return 'latlng'
+    return path.rsplit('/', 1)[-1] or 'other'
+
+
+
+class RetryPolicy(object):
+    """
+    Describes how a `Transport` retries failed requests: requests which 
+    can't reach the service, or which receive one of `statuses`, are 
+    retried after an exponentially increasing, randomised delay.
+
+    :param retries: maximum number of retries after the first attempt.
+
+    :param backoff: seconds to wait before the first retry, doubling 
+                    for each retry after it.
+
+    :param max_backoff: maximum number of seconds to wait between 
+                        attempts.
+
+    :param jitter: whether to randomise each delay between zero and its 
+                   full length, so that clients don't retry in lockstep.
+
+    :param deadline: optional number of seconds all attempts at a 
+                     request must complete within.
+
+    :param statuses: HTTP statuses which are worth retrying.
+    """
+
+    def __init__(self, retries=2, backoff=0.1, max_backoff=5, jitter=True,
+                 deadline=None, statuses=(429, 500, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.statuses = frozenset(statuses)
+
+    def delay(self, attempt):
+        """ Returns the seconds to wait after failed attempt `attempt`. """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if not self.jitter:
+            return delay
+        import random
+        return random.uniform(0, delay)
+
+
+class CircuitBreaker(object):
+    """
+    Fails requests fast while the web-service is unhealthy. After 
+    `failure_threshold` consecutive failed attempts at requests, 
+    counting each retry as an attempt, the breaker opens, and requests 
+    fail immediately with a `CircuitOpenException`. Once 
+    `reset_timeout` seconds have passed a single trial request is let 
+    through, which closes the breaker again if it succeeds.
+
+    A `CircuitBreaker` can be shared between transports.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ One of ``'closed'``, ``'open'`` or ``'half-open'``. """
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            if self._trial or _now() - self._opened >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        """ Returns whether a request may be made now. """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or _now() - self._opened < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, success):
+        """ Records the outcome of a request allowed by `allow`. """
+        with self._lock:
+            self._trial = False
+            if success:
+                self.failures, self._opened = 0, None
+                return
+            self.failures += 1
+            if (self._opened is not None or 
+                    self.failures >= self.failure_threshold):
+                self._opened = _now()
+
+
+class RateLimiter(object):
+    """
+    A token bucket which limits requests to `rate` per second on 
+    average, while allowing bursts of up to `burst` requests. Callers 
+    which exceed the rate wait their turn. A `RateLimiter` is safe to 
+    share between threads and transports.
+
+    :param rate: average number of requests per second.
+
+    :param burst: maximum number of requests which can be made at once 
+                  after a quiet period. Defaults to `rate`.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive, not %r" % (rate,))
+        self.rate = float(rate)
+        self.burst = float(max(1, rate if burst is None else burst))
+        self._tokens = self.burst
+        self._updated = _now()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """ 
+        Waits until a request may be made, unless that would take more 
+        than `timeout` seconds.
+
+        :returns: whether a request may be made.
+        """
+        with self._lock:
+            now = _now()
+            self._tokens = min(self.burst, self._tokens + 
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0
+            if timeout is not None and wait > timeout:
+                return False
+            # reserve a token now, so waiting callers are served in order
+            self._tokens -= 1
+        if wait > 0:
+            _sleep(wait)
+        return True
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of concurrent requests, adapting the limit to the 
+    service's health: the limit grows additively while requests succeed 
+    within `latency_target` seconds, and is cut multiplicatively when 
+    they fail or are slow. An `AdaptiveLimiter` is safe to share between 
+    threads and transports.
+
+    :param initial: the initial concurrency limit.
+
+    :param min_limit: the lowest the limit can fall to.
+
+    :param max_limit: the highest the limit can rise to.
+
+    :param latency_target: seconds above which a request counts as slow.
+
+    :param backoff: factor the limit is multiplied by after a failed or 
+                    slow request.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, 
+                 latency_target=1.0, backoff=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.inflight = 0
+        self._limit = float(initial)
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """ The current concurrency limit. """
+        return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """ 
+        Waits until a request may be made, for up to `timeout` seconds.
+
+        :returns: whether a request may be made.
+        """
+        deadline = None if timeout is None else _now() + timeout
+        with self._cond:
+            while self.inflight >= int(self._limit):
+                remaining = _remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.inflight += 1
+            return True
+
+    def release(self, latency, success):
+        """ 
+        Records the outcome of a request allowed by `acquire`, which 
+        took `latency` seconds.
+        """
+        with self._cond:
+            self.inflight -= 1
+            if success and latency <= self.latency_target:
+                # grows by about one for each limit's worth of requests
+                self._limit = min(self.max_limit, 
+                                  self._limit + 1.0 / self._limit)
+            else:
+                self._limit = max(self.min_limit, 
+                                  self._limit * self.backoff)
+            self._cond.notify_all()
+
+
+class Transport(object):
+    """
+    Makes requests to the web-service over a pool of persistent 
+    (keep-alive) connections to each host, rather than opening a new 
+    connection for every request. A `Transport` is safe to share between 
+    threads, and can be passed to any of the functions in this module 
+    or to a `PostCoder`. Like ``urlopen``, it follows up to 
+    `MAX_REDIRECTS` redirects, and by default connects through the 
+    proxies given by the ``http_proxy``, ``https_proxy`` and 
+    ``no_proxy`` environment variables (or the system's settings).
+
+    :param pool_size: maximum number of idle connections kept open to 
+                      each host.
+
+    :param connect_timeout: seconds to wait when opening a connection.
+
+    :param read_timeout: seconds to wait for the service to respond.
+
+    :param gzip: whether to ask the service for gzip compressed 
+                 responses.
+
+    :param retry: optional `RetryPolicy` for failed requests. Defaults 
+                  to a policy of two quick retries; ``RetryPolicy(0)`` 
+                  disables retries.
+
+    :param breaker: optional `CircuitBreaker` to stop making requests 
+                    while the service is unhealthy.
+
+    :param limiter: optional `RateLimiter` to limit the rate requests 
+                    are made at.
+
+    :param concurrency: optional `AdaptiveLimiter` to limit the number of 
+                        requests made at once. Streamed requests only 
+                        count until their response starts.
+
+    :param proxies: optional dict mapping URL schemes (``'http'`` and 
+                    ``'https'``) to the URLs of the proxies to use for 
+                    them, such as ``{'https': 'http://proxy:3128'}``, 
+                    instead of those from the environment. ``{}`` 
+                    disables proxies.
+    """
+
+    #: The number of redirects followed for each request.
+    MAX_REDIRECTS = 5
+
+    def __init__(self, pool_size=4, connect_timeout=10, read_timeout=30,
+                 gzip=True, retry=None, breaker=None, limiter=None,
+                 concurrency=None, proxies=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip = gzip
+        self.retry = RetryPolicy() if retry is None else retry
+        self.breaker = breaker
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.proxies = proxies
+        self._environment = None # proxies, bypass function
+        self._pools = {} # (scheme, host) -> idle connections
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(['requests', 'attempts', 'retries', 
+                                     'successes', 'failures', 
+                                     'short_circuits'], 0)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+        if _metrics is not None:
+            _metrics.count('transport.' + name)
+
+    def stats(self):
+        """
+        Returns a dict counting the requests made, the attempts at them, 
+        the retries, the requests which succeeded or failed, and those 
+        which failed fast because the circuit breaker was open.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _acquire(self, scheme, host, timeout=None):
+        """ 
+        Returns an idle connection to `host` if there is one, otherwise 
+        a new connection, along with whether the connection was reused.
+        """
+        with self._lock:
+            idle = self._pools.get((scheme, host))
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if not reused:
+            cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+            proxy = self._proxy(scheme, host)
+            if proxy is None:
+                conn = cls(host, timeout=_min(self.connect_timeout, timeout))
+            else:
+                # HTTPS requests are tunnelled through the proxy
+                address, headers = proxy
+                conn = cls(address, timeout=_min(self.connect_timeout, 
+                                                 timeout))
+                if scheme == 'https':
+                    conn.set_tunnel(host, headers=headers)
+            conn.connect()
+        conn.sock.settimeout(_min(self.read_timeout, timeout))
+        return conn, reused
+
+    def _release(self, scheme, host, conn):
+        with self._lock:
+            idle = self._pools.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _proxy(self, scheme, host):
+        """ 
+        Returns the address of the proxy to connect to `host` through, 
+        and the headers to send it, or None to connect directly.
+        """
+        if self.proxies is not None:
+            proxy = self.proxies.get(scheme)
+        else:
+            if self._environment is None:
+                self._environment = _environment_proxies()
+            proxies, bypass = self._environment
+            proxy = proxies.get(scheme)
+            if proxy and bypass(host):
+                proxy = None
+        if not proxy:
             return None
-    else:
-        return json.loads(resp.read().decode('utf-8'))
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        credentials, _, address = urlsplit(proxy).netloc.rpartition('@')
+        headers = {}
+        if credentials:
+            import base64
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+        return address, headers
+
+    def _open(self, url, timeout=None):
+        """
+        Sends a GET request for `url`, following redirects, returning 
+        the connection's pool key, the connection and its response, 
+        whose body is unread.
+        """
+        if urlsplit is None:
+            _import_http()
+        deadline = None if timeout is None else _now() + timeout
+        for _ in range(self.MAX_REDIRECTS + 1):
+            key, conn, resp = self._open_once(url, timeout)
+            location = resp.getheader('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or \
+                    not location:
+                return key, conn, resp
+            try:
+                resp.read()
+            except (socket.error, HTTPException):
+                conn.close()
+            else:
+                self._finish(key, conn, resp)
+            url = urljoin(url, location)
+            if urlsplit(url).scheme not in ('http', 'https'):
+                raise ServiceException("Request redirected to %s" % url)
+            timeout = _remaining(deadline)
+            if timeout is not None and timeout <= 0:
+                raise ServiceException("Request for %s exceeded its "
+                                       "deadline" % url)
+        raise ServiceException("Request for %s was redirected too many "
+                               "times" % url)
+
+    def _open_once(self, url, timeout):
+        """ Sends a GET request for `url`, without following redirects. """
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        headers = {'Accept-Encoding': 'gzip'} if self.gzip else {}
+        proxy = self._proxy(*key) if parts.scheme == 'http' else None
+        if proxy is not None:
+            # plain HTTP requests are sent to the proxy with the full URL
+            path = url
+            headers.update(proxy[1])
+        else:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+        deadline = None if timeout is None else _now() + timeout
+        while True:
+            conn, reused = None, False
+            try:
+                conn, reused = self._acquire(key[0], key[1], timeout)
+                conn.request('GET', path, headers=headers)
+                return key, conn, conn.getresponse()
+            except (socket.error, HTTPException) as e:
+                if conn is not None:
+                    conn.close()
+                if not reused or not _disconnected(e):
+                    raise ServiceException("Request for %s failed: %s" % 
+                                           (url, e))
+            # the service had closed an idle connection, so the request 
+            # can safely be sent again on another
+            if deadline is not None:
+                timeout = deadline - _now()
+                if timeout <= 0:
+                    raise ServiceException("Request for %s exceeded its "
+                                           "deadline" % url)
+
+    def _finish(self, key, conn, resp):
+        """ Returns a connection whose response has been read to the pool. """
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key[0], key[1], conn)
+
+    def _with_retries(self, url, send, discard):
+        """
+        Makes a request by calling ``send(timeout)``, which returns an 
+        HTTP status and a result, retrying it and consulting the circuit 
+        breaker as configured. ``discard(result)`` is called for the 
+        results of failed attempts which are retried.
+        """
+        retry, breaker = self.retry, self.breaker
+        deadline = None if retry.deadline is None else \
+                   _now() + retry.deadline
+        self._count('requests')
+        attempt = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                self._count('short_circuits')
+                raise CircuitOpenException("Not requesting %s while the "
+                                           "service is unhealthy" % url)
+            status, result, error = None, None, None
+            self._count('attempts')
+            failed = True
+            try:
+                try:
+                    status, result = self._send(url, send, deadline)
+                except ServiceException as e:
+                    error = e
+                failed = error is not None or status in retry.statuses
+            finally:
+                # even unexpected errors must end a half-open trial
+                if breaker is not None:
+                    breaker.record(not failed)
+            if not failed:
+                self._count('successes')
+                return status, result
+            delay = retry.delay(attempt)
+            if attempt >= retry.retries or (deadline is not None and 
+                                            _now() + delay >= deadline):
+                self._count('failures')
+                if error is not None:
+                    raise error
+                return status, result
+            if result is not None:
+                discard(result)
+            self._count('retries')
+            attempt += 1
+            _sleep(delay)
+
+    def _send(self, url, send, deadline):
+        """ 
+        Calls ``send(timeout)`` within the transport's limits, with the 
+        time left before `deadline` once the limiters allow it.
+        """
+        expired = ServiceException("Request for %s exceeded its deadline" % 
+                                   url)
+        if self.limiter is not None and \
+                not self.limiter.acquire(_remaining(deadline)):
+            raise expired
+        if self.concurrency is not None and \
+                not self.concurrency.acquire(_remaining(deadline)):
+            raise expired
+        start, success = None, False
+        try:
+            timeout = _remaining(deadline)
+            if timeout is not None and timeout <= 0:
+                raise expired
+            if self.concurrency is not None:
+                start = _now()
+            status, result = send(timeout)
+            success = status not in self.retry.statuses
+            return status, result
+        finally:
+            if self.concurrency is not None:
+                self.concurrency.release(0 if start is None else 
+                                         _now() - start, success)
+
+    def request(self, url):
+        """
+        Makes a GET request for `url`, retrying it according to the 
+        transport's `RetryPolicy`.
+
+        :raises ServiceException: if the service can't be reached.
+
+        :raises CircuitOpenException: if the circuit breaker is open.
+
+        :returns: a tuple of the response's HTTP status and its 
+                  (decompressed) body.
+        """
+        return self._with_retries(url, lambda timeout: 
+                                  self._request(url, timeout), 
+                                  discard=lambda body: None)
+
+    def _request(self, url, timeout):
+        key, conn, resp = self._open(url, timeout)
+        try:
+            body = resp.read()
+        except (socket.error, HTTPException) as e:
+            conn.close()
+            raise ServiceException("Request for %s failed: %s" % (url, e))
+        self._finish(key, conn, resp)
+        if _metrics is not None:
+            _metrics.count('bytes.' + _endpoint(url), len(body))
+        if resp.getheader('Content-Encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                raise ServiceException("Request for %s returned a corrupt "
+                                       "response: %s" % (url, e))
+        return resp.status, body
 
-def get(postcode):
+    def stream(self, url, chunk_size=65536):
+        """
+        Makes a GET request for `url`, without reading the response's 
+        body up front. Only failures before the body is read are retried.
+
+        :raises ServiceException: if the service can't be reached.
+
+        :raises CircuitOpenException: if the circuit breaker is open.
+
+        :returns: a tuple of the response's HTTP status and an iterator 
+                  of (decompressed) chunks of its body. The iterator 
+                  should be exhausted or closed.
+        """
+        def send(timeout):
+            key, conn, resp = self._open(url, timeout)
+            return resp.status, self._chunks(url, key, conn, resp, 
+                                             chunk_size)
+        return self._with_retries(url, send, discard=_drain)
+
+    def _chunks(self, url, key, conn, resp, chunk_size):
+        decompressor = None
+        if resp.getheader('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        done = False
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                if _metrics is not None:
+                    _metrics.count('bytes.' + _endpoint(url), len(chunk))
+                yield decompressor.decompress(chunk) if decompressor \
+                      else chunk
+            if decompressor:
+                yield decompressor.flush()
+            done = True
+        except (socket.error, HTTPException) as e:
+            raise ServiceException("Request for %s failed: %s" % (url, e))
+        except zlib.error as e:
+            raise ServiceException("Request for %s returned a corrupt "
+                                   "response: %s" % (url, e))
+        finally:
+            if done:
+                self._finish(key, conn, resp)
+            else:
+                conn.close()
+
+    def close(self):
+        """ Closes all idle connections. """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+
+def _remaining(deadline):
+    """ Returns the seconds left before an optional `deadline`. """
+    return None if deadline is None else deadline - _now()
+
+def _min(a, b):
+    """ Returns the smaller of two optional timeouts. """
+    return a if b is None else b if a is None else min(a, b)
+
+def _disconnected(error):
+    """ 
+    Whether `error` shows the service closed a connection before 
+    responding on it, rather than the request failing or timing out.
+    """
+    if isinstance(error, RemoteDisconnected):
+        return True
+    return not isinstance(error, socket.timeout) and \
+           getattr(error, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+
+def _drain(chunks):
+    """ Reads the rest of a streamed response, so it can be reused. """
+    try:
+        for _ in chunks:
+            pass
+    except ServiceException:
+        pass
+
+
+_default_transport = Transport()
+
+def set_default_transport(transport):
+    """
+    Sets the `Transport` used for requests which don't specify one, 
+    including those of every `PostCoder` created without a transport. 
+    This is the way to apply a `RateLimiter` or `AdaptiveLimiter` to 
+    all of the requests made by a process.
+    """
+    global _default_transport
+    _default_transport = transport
+
+_fast_loads = None
+
+def _loads(data):
+    """
+    Decodes JSON from UTF-8 encoded `data`, with orjson, ujson or 
+    simplejson if one of them is installed, as they're faster than the 
+    standard library's json module.
+    """
+    global _fast_loads
+    if _fast_loads is None:
+        for name in ('orjson', 'ujson', 'simplejson'):
+            try:
+                _fast_loads = __import__(name).loads
+                break
+            except ImportError:
+                pass
+        else:
+            import json
+            _fast_loads = lambda data: json.loads(data.decode('utf-8'))
+    return _fast_loads(data)
+
+def _decode_json_resp(url, status, body):
+    if status == 404: # no available data
+        return None
+    if status != 200:
+        raise ServiceException("Request for %s failed with HTTP status %s" %
+                               (url, status), status)
+    try:
+        return _loads(body)
+    except ValueError as e:
+        raise ServiceException("Request for %s returned invalid JSON: %s" % 
+                               (url, e))
+
+def _get_json_resp(url, transport=None):
+    metrics = _metrics
+    if metrics is None:
+        status, body = (transport or _default_transport).request(url)
+        return _decode_json_resp(url, status, body)
+    endpoint = _endpoint(url)
+    metrics.gauge('inflight.' + endpoint, 1)
+    start = _now()
+    try:
+        status, body = (transport or _default_transport).request(url)
+    finally:
+        metrics.gauge('inflight.' + endpoint, -1)
+        metrics.observe('latency.' + endpoint, _now() - start)
+    start = _now()
+    try:
+        return _decode_json_resp(url, status, body)
+    finally:
+        metrics.observe('decode.' + endpoint, _now() - start)
+
+def _iter_json_array(chunks):
+    """
+    Incrementally parses a JSON array from an iterable of byte `chunks`, 
+    yielding each of its items as soon as it has been read.
+    """
+    import json
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, state = '', 0, 'start'
+    for chunk in chunks:
+        try:
+            buf = buf[pos:] + text.decode(chunk)
+        except UnicodeDecodeError as e:
+            raise ServiceException("Invalid JSON array: %s" % e)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+            if state == 'start':
+                if buf[pos] != '[':
+                    raise ServiceException("Expected a JSON array")
+                pos, state = pos + 1, 'first'
+            elif state == 'first' and buf[pos] == ']':
+                return
+            elif state == 'next':
+                if buf[pos] == ']':
+                    return
+                if buf[pos] != ',':
+                    raise ServiceException("Malformed JSON array")
+                pos, state = pos + 1, 'item'
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    break # wait for the rest of the item
+                if end == len(buf) and not isinstance(item, (dict, list)):
+                    break # a number or literal may be incomplete
+                yield item
+                pos, state = end, 'next'
+    raise ServiceException("Truncated JSON array")
+
+def _iter_json_resp(url, transport=None):
+    status, chunks = (transport or _default_transport).stream(url)
+    try:
+        if status == 404: # no available data
+            _drain(chunks)
+            return
+        if status != 200:
+            _drain(chunks)
+            raise ServiceException("Request for %s failed with HTTP status "
+                                   "%s" % (url, status), status)
+        for item in _iter_json_array(chunks):
+            yield item
+    finally:
+        chunks.close()
+
+def _postcode_url(postcode):
+    if quote is None:
+        _import_http()
+    postcode = quote(postcode.replace(' ', ''))
+    return '%s/postcode/%s.json' % (END_POINT, postcode)
+
+def _nearest_url(lat, lng):
+    return '%s/latlng/%s,%s.json' % (END_POINT, lat, lng)
+
+def _distance_url(distance, *dist_params):
+    params = '&'.join([p for p in dist_params])
+    query = '%s&distance=%s&format=%s' % (params, distance, 'json')
+    return '%s/distance.php?%s' % (END_POINT, query)
+
+def get(postcode, transport=None, dataset=None):
     """
     Request data associated with `postcode`.
 
     :param postcode: the postcode to search for. The postcode may 
                      contain spaces (they will be removed).
 
+    :param transport: optional `Transport` to make the request with.
+
+    :param dataset: optional `LocalDataset` to look `postcode` up in, 
+                    instead of requesting it from the web-service.
+
     :returns: a dict of the nearest postcode's data or None if no 
               postcode data is found.
     """
-    postcode = quote(postcode.replace(' ', ''))
-    url = '%s/postcode/%s.json' % (END_POINT, postcode)
-    return _get_json_resp(url)
+    if dataset is not None:
+        return dataset.get(postcode)
+    return _get_json_resp(_postcode_url(postcode), transport=transport)
 
-def get_nearest(lat, lng):
+def get_nearest(lat, lng, transport=None, dataset=None):
     """
     Request the nearest `postcode` to a geographical point, 
     specified by `lat` and `lng`.
@@ -42,18 +947,25 @@ def get_nearest(lat, lng):
 
     :param lng: longitude of point.
 
+    :param transport: optional `Transport` to make the request with.
+
+    :param dataset: optional `LocalDataset` to search instead of 
+                    requesting from the web-service.
+
     :returns: a dict of the nearest postcode's data.
     """
-    url = '%s/latlng/%s,%s.json' % (END_POINT, lat, lng)
-    return _get_json_resp(url)
+    if dataset is not None:
+        return dataset.nearest(float(lat), float(lng))
+    return _get_json_resp(_nearest_url(lat, lng), transport=transport)
 
-def _get_from(distance, *dist_params):
-    params = '&'.join([p for p in dist_params])
-    query = '%s&distance=%s&format=%s' % (params, distance, 'json')
-    url = '%s/distance.php?%s' % (END_POINT, query)
-    return _get_json_resp(url)
+def _get_from(distance, *dist_params, **kwargs):
+    url = _distance_url(distance, *dist_params)
+    if kwargs.get('stream'):
+        return _iter_json_resp(url, transport=kwargs.get('transport'))
+    return _get_json_resp(url, transport=kwargs.get('transport'))
 
-def get_from_postcode(postcode, distance):
+def get_from_postcode(postcode, distance, transport=None, dataset=None,
+                      stream=False):
     """
     Request all postcode data within `distance` miles of `postcode`.
 
@@ -62,13 +974,31 @@ def get_from_postcode(postcode, distance):
 
     :param distance: distance in miles to `postcode`.
 
+    :param transport: optional `Transport` to make the request with.
+
+    :param dataset: optional `LocalDataset` to search instead of 
+                    requesting from the web-service.
+
+    :param stream: if true, return an iterator which parses and yields 
+                   each postcode's data as it's received, so that large 
+                   responses needn't be held in memory. An invalid 
+                   `postcode` yields nothing.
+
     :returns: a list of dicts containing postcode data within the 
               specified distance or `None` if `postcode` is not valid.
     """
+    if dataset is not None:
+        result = dataset.within_postcode(postcode, float(distance))
+        return iter(result or ()) if stream else result
+    if quote is None:
+        _import_http()
     postcode = quote(postcode.replace(' ', ''))
-    return _get_from(distance, 'postcode=%s' % postcode)
+    kwargs = {'stream': True} if stream else {}
+    return _get_from(distance, 'postcode=%s' % postcode, 
+                     transport=transport, **kwargs)
 
-def get_from_geo(lat, lng, distance):
+def get_from_geo(lat, lng, distance, transport=None, dataset=None,
+                 stream=False):
     """
     Request all postcode data within `distance` miles of a 
     geographical point specified by `lat` and `lng`.
@@ -79,10 +1009,24 @@ def get_from_geo(lat, lng, distance):
 
     :param distance: distance in miles to `postcode`.
 
+    :param transport: optional `Transport` to make the request with.
+
+    :param dataset: optional `LocalDataset` to search instead of 
+                    requesting from the web-service.
+
+    :param stream: if true, return an iterator which parses and yields 
+                   each postcode's data as it's received, so that large 
+                   responses needn't be held in memory.
+
     :returns: a list of dicts containing postcode data within the 
               specified distance.
     """
-    return _get_from(distance, 'lat=%s' % lat, 'lng=%s' % lng)
+    if dataset is not None:
+        result = dataset.within(float(lat), float(lng), float(distance))
+        return iter(result) if stream else result
+    kwargs = {'stream': True} if stream else {}
+    return _get_from(distance, 'lat=%s' % lat, 'lng=%s' % lng, 
+                     transport=transport, **kwargs)
 
 
 class IllegalPointException(Exception):
@@ -96,7 +1040,1127 @@ class IllegalDistanceException(Exception):
     Raised when an illegal distance is specified in a request.
     """
     pass
-        
+
+class ServiceException(Exception):
+    """
+    Raised when the web-service can't be reached, or responds with an 
+    unexpected error. `status` is the HTTP status of the response, if 
+    there was one.
+    """
+    def __init__(self, msg, status=None):
+        super(ServiceException, self).__init__(msg)
+        self.status = status
+
+class CircuitOpenException(ServiceException):
+    """
+    Raised when a request isn't made because a `CircuitBreaker` has 
+    found the web-service to be unhealthy.
+    """
+    pass
+
+
+_POSTCODE_RE = None # compiled when first used
+
+def is_valid_postcode(postcode):
+    """
+    Checks whether `postcode` has the format of a UK postcode, ignoring 
+    case and spaces. This doesn't check the postcode exists.
+    """
+    global _POSTCODE_RE
+    if _POSTCODE_RE is None:
+        import re
+        _POSTCODE_RE = re.compile(
+            r'^(GIR0AA|[A-Z]{1,2}[0-9][A-Z0-9]?[0-9][A-Z]{2})$')
+    return _POSTCODE_RE.match(postcode.upper().replace(' ', '')) is not None
+
+def _normalise_postcode(postcode):
+    """ Removes spaces and changes case, so that cache keys match. """
+    return postcode.lower().replace(' ', '')
+
+def _check_point(lat, lng):
+    if abs(lat) > 90 or abs(lng) > 180:
+        msg = "Illegal lat and/or lng, (%s, %s) provided." % (lat, lng)
+        raise IllegalPointException(msg)
+
+def _check_distance(distance):
+    if distance < 0:
+        raise IllegalDistanceException("Distance must not be negative")
+
+
+def _sizeof(obj):
+    """ Rough recursive estimate of the memory held by `obj`, in bytes. """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(v) for v in obj)
+    return size
+
+
+class LRUCache(object):
+    """
+    A bounded cache which evicts the least recently used entries once 
+    it holds more than `max_entries` entries or more than `max_bytes` 
+    bytes of data. Lookups and insertions are O(1).
+
+    Any object providing ``get(key, default)`` and ``cache[key] = value`` 
+    can be given to a `PostCoder` as its cache; a plain ``dict`` works 
+    too, but never evicts anything.
+
+    :param max_entries: optional maximum number of cached responses.
+
+    :param max_bytes: optional maximum (estimated) size of all cached 
+                      responses, in bytes.
+
+    :param sizeof: optional function used to estimate the size of a 
+                   cached response, in bytes.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or _sizeof
+        self.hits = self.misses = self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict() # key -> (value, size, expires)
+        self._lock = threading.RLock()
+
+    def _expires(self):
+        return None
+
+    def _expire(self, key, entry):
+        """ Removes `key` if `entry` has expired and reports if it did. """
+        if entry[2] is None or entry[2] > _now():
+            return False
+        del self._data[key]
+        self.bytes -= entry[1]
+        return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data[key] = entry # re-insert as most recently used
+            if self._expire(key, entry):
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, size, self._expires())
+            self.bytes += size
+            while self._data and (
+                    (self.max_entries is not None and 
+                     len(self._data) > self.max_entries) or
+                    (self.max_bytes is not None and 
+                     self.bytes > self.max_bytes)):
+                _, entry = self._data.popitem(last=False)
+                self.bytes -= entry[1]
+                self.evictions += 1
+                if _metrics is not None:
+                    _metrics.count('cache.evictions')
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.bytes -= self._data.pop(key)[1]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and not self._expire(key, entry)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def items(self):
+        """ 
+        Returns a list of the cache's unexpired (key, value) pairs, from 
+        least to most recently used, without affecting their order.
+        """
+        with self._lock:
+            now = _now()
+            return [(key, entry[0]) for key, entry in self._data.items()
+                    if entry[2] is None or entry[2] > now]
+
+    def stats(self):
+        """ 
+        Returns a dict of the cache's size and hit, miss and eviction 
+        counters.
+        """
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses, 
+                    'evictions': self.evictions}
+
+
+class TTLCache(LRUCache):
+    """
+    An `LRUCache` whose entries also expire `ttl` seconds after they 
+    were stored. Expired entries count as misses.
+
+    :param ttl: number of seconds an entry remains valid for.
+    """
+
+    def __init__(self, ttl, max_entries=None, max_bytes=None, sizeof=None):
+        super(TTLCache, self).__init__(max_entries, max_bytes, sizeof)
+        self.ttl = ttl
+
+    def _expires(self):
+        return _now() + self.ttl
+
+
+class SQLiteCache(object):
+    """
+    A persistent cache stored in an SQLite database at `path`. It can 
+    be shared by any number of threads and processes, and survives 
+    restarts, so warm processes don't need to re-request data.
+
+    Responses are stored as compressed JSON, and the database is only 
+    opened when the cache is first used. 
+
+    :param path: path to the database file, which is created if needed.
+
+    :param max_entries: optional maximum number of cached responses, 
+                        beyond which the oldest responses are removed.
+
+    :param timeout: seconds to wait for another process's write lock.
+    """
+
+    def __init__(self, path, max_entries=None, timeout=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = self.misses = 0
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        # connections can't be shared between threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, value BLOB)')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _key(self, key):
+        import json
+        return json.dumps(key, separators=(',', ':'))
+
+    def get(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM cache WHERE key = ?',
+                                 (self._key(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return _loads(zlib.decompress(row[0]))
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        import json
+        data = json.dumps(value, separators=(',', ':'), 
+                          default=_to_json).encode('utf-8')
+        conn = self._conn
+        conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?)',
+                     (self._key(key), zlib.compress(data)))
+        if self.max_entries is not None:
+            # rewritten keys get new rowids, leaving gaps, so the oldest 
+            # entries are counted rather than found from the last rowid
+            conn.execute('DELETE FROM cache WHERE rowid IN '
+                         '(SELECT rowid FROM cache ORDER BY rowid LIMIT '
+                         'max(0, (SELECT COUNT(*) FROM cache) - ?))',
+                         (self.max_entries,))
+
+    def __delitem__(self, key):
+        self._conn.execute('DELETE FROM cache WHERE key = ?', 
+                           (self._key(key),))
+
+    def __contains__(self, key):
+        return self._conn.execute('SELECT 1 FROM cache WHERE key = ?',
+                                  (self._key(key),)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def clear(self):
+        self._conn.execute('DELETE FROM cache')
+
+    def items(self):
+        """ Yields the cache's (key, value) pairs, oldest first. """
+        import json
+        rows = self._conn.execute('SELECT key, value FROM cache '
+                                  'ORDER BY rowid')
+        for key, value in rows:
+            yield (tuple(json.loads(key)), 
+                   _loads(zlib.decompress(value)))
+
+    def stats(self):
+        """ Returns a dict of the cache's size and hit and miss counters. """
+        return {'entries': len(self), 'hits': self.hits, 
+                'misses': self.misses}
+
+
+_GEOHASH_CHARS = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def _geohash(lat, lng, precision=12):
+    """ Encodes a point as a geohash string of `precision` characters. """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even, bits = not even, bits + 1
+        if bits == 5:
+            chars.append(_GEOHASH_CHARS[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+class LocalDataset(object):
+    """
+    An offline postcode dataset, which answers lookups from a compact 
+    index file rather than the web-service. The index is built once 
+    from a postcode CSV file with `LocalDataset.build`, and is memory 
+    mapped when loaded, so it is cheap to open and can be shared by 
+    many processes. Index files are specific to the byte order of the 
+    machine that built them.
+
+    Lookups return dicts in the same shape as the web-service's, 
+    although the administrative areas only include their codes.
+
+    :param path: path to an index file built by `LocalDataset.build`.
+    """
+
+    MAGIC = b'PCDX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIII')
+
+    #: The CSV columns read by `build`, as named in the ONS Postcode 
+    #: Directory.
+    COLUMNS = {'postcode': 'pcds', 'lat': 'lat', 'lng': 'long',
+               'easting': 'oseast1m', 'northing': 'osnrth1m', 
+               'district': 'laua', 'ward': 'osward', 
+               'constituency': 'pcon'}
+
+    _FLOATS = ('lat', 'lng')
+    _INTS = ('easting', 'northing', 'district', 'ward', 'constituency')
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._width, table_len = \
+            self.HEADER.unpack_from(self._mmap)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("%s is not a postcode index" % path)
+        view, offset = memoryview(self._mmap), self.HEADER.size
+        self._keys = view[offset:offset + self._count * self._width]
+        offset += _align(self._count * self._width)
+        for name in self._FLOATS + self._INTS:
+            fmt = 'd' if name in self._FLOATS else 'i'
+            size = self._count * struct.calcsize(fmt)
+            setattr(self, '_' + name, view[offset:offset + size].cast(fmt))
+            offset += size
+        self._codes = _loads(bytes(view[offset:offset + table_len]))
+        self._spatial = self._np_arrays = None
+
+    @classmethod
+    def build(cls, csv_path, index_path, columns=None):
+        """
+        Builds an index file at `index_path` from the postcode CSV file 
+        at `csv_path`, and returns the loaded dataset. Postcodes without 
+        a location are skipped.
+
+        :param columns: optional dict mapping any of the keys of 
+                        `LocalDataset.COLUMNS` to the CSV's own column 
+                        names.
+        """
+        import csv
+        import json
+        columns = dict(cls.COLUMNS, **(columns or {}))
+        rows, codes, code_ids = [], [''], {'': 0}
+        def code_id(code):
+            if code not in code_ids:
+                code_ids[code] = len(codes)
+                codes.append(code)
+            return code_ids[code]
+        with open(csv_path) as f:
+            for row in csv.DictReader(f):
+                try:
+                    lat, lng = (float(row[columns['lat']]), 
+                                float(row[columns['lng']]))
+                except ValueError:
+                    continue
+                if abs(lat) > 90 or abs(lng) > 180: # no location
+                    continue
+                key = row[columns['postcode']].upper().replace(' ', '')
+                rows.append((key.encode('ascii'), lat, lng, 
+                    int(row.get(columns['easting']) or 0), 
+                    int(row.get(columns['northing']) or 0),
+                    code_id(row.get(columns['district'], '')), 
+                    code_id(row.get(columns['ward'], '')), 
+                    code_id(row.get(columns['constituency'], ''))))
+        rows.sort()
+        width = max([len(row[0]) for row in rows] or [1])
+        table = json.dumps(codes).encode('utf-8')
+        with open(index_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(rows), 
+                                    width, len(table)))
+            keys = b''.join(row[0].ljust(width) for row in rows)
+            f.write(keys.ljust(_align(len(keys)), b'\0'))
+            names = cls._FLOATS + cls._INTS
+            for i, name in enumerate(names, 1):
+                fmt = 'd' if name in cls._FLOATS else 'i'
+                f.write(array.array(fmt, [row[i] for row in rows]).tobytes())
+            f.write(table)
+        return cls(index_path)
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        return bytes(self._keys[i * self._width:(i + 1) * self._width])
+
+    def _find(self, postcode):
+        """ Returns the row index of `postcode`, or None. """
+        key = postcode.upper().replace(' ', '').encode('ascii', 'replace')
+        if len(key) > self._width:
+            return None
+        key = key.ljust(self._width)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._key(lo) == key:
+            return lo
+        return None
+
+    def _format(self, key):
+        """ Formats an index key as a postcode, with its space. """
+        key = key.decode('ascii').rstrip()
+        return '%s %s' % (key[:-3], key[-3:])
+
+    def _record(self, i):
+        """ Returns the data for row `i`, in the web-service's shape. """
+        lat, lng = self._lat[i], self._lng[i]
+        area = lambda name, code_name: {
+            code_name: self._codes[getattr(self, '_' + name)[i]], 
+            'title': '', 'uri': ''}
+        return {
+            'postcode': self._format(self._key(i)),
+            'geo': {'lat': '%.6f' % lat, 'lng': '%.6f' % lng,
+                    'easting': str(self._easting[i]), 
+                    'northing': str(self._northing[i]),
+                    'geohash': 'http://geohash.org/%s' % _geohash(lat, lng)},
+            'administrative': {
+                'district': area('district', 'snac'),
+                'ward': area('ward', 'snac'),
+                'constituency': area('constituency', 'code')},
+        }
+
+    def get(self, postcode):
+        """
+        Looks up `postcode` in the dataset.
+
+        :returns: a dict of the postcode's data or None if the postcode 
+                  isn't in the dataset.
+        """
+        i = self._find(postcode)
+        return None if i is None else self._record(i)
+
+    @property
+    def spatial(self):
+        """ The dataset's `SpatialIndex`, built the first time it's used. """
+        if self._spatial is None:
+            self._spatial = SpatialIndex(self)
+        return self._spatial
+
+    def nearest(self, lat, lng):
+        """
+        Finds the postcode nearest to a geographical point.
+
+        :returns: a dict of the nearest postcode's data or None if the 
+                  dataset is empty.
+        """
+        results = self.spatial.nearest(lat, lng)
+        return results[0][0] if results else None
+
+    def _arrays(self):
+        """ Returns the lat and lng columns as NumPy arrays. """
+        if self._np_arrays is None:
+            np = _numpy()
+            self._np_arrays = (np.frombuffer(self._lat, dtype=np.float64),
+                               np.frombuffer(self._lng, dtype=np.float64))
+        return self._np_arrays
+
+    def within(self, lat, lng, distance, limit=None):
+        """
+        Finds the postcodes within `distance` miles of a geographical 
+        point, using the dataset's `SpatialIndex`.
+
+        :param limit: optional maximum number of postcodes to return.
+
+        :returns: a list of dicts of postcode data, nearest first, each 
+                  with an extra ``distance`` in miles.
+        """
+        results = []
+        for record, dist in self.spatial.within(lat, lng, distance, limit):
+            record['distance'] = '%.6f' % dist
+            results.append(record)
+        return results
+
+    def within_postcode(self, postcode, distance, limit=None):
+        """
+        Finds the postcodes within `distance` miles of `postcode`.
+
+        :returns: a list like `within`'s, or None if `postcode` isn't in 
+                  the dataset.
+        """
+        i = self._find(postcode)
+        if i is None:
+            return None
+        return self.within(self._lat[i], self._lng[i], distance, limit)
+
+    def close(self):
+        """ Unmaps the index file. """
+        self._np_arrays = None
+        for name in ('_keys',) + tuple('_' + n for n in 
+                                       self._FLOATS + self._INTS):
+            getattr(self, name).release()
+        self._mmap.close()
+
+
+def _align(size, to=8):
+    return (size + to - 1) // to * to
+
+
+_EARTH_RADIUS = 3958.8 # miles
+_MILES_PER_DEGREE = _EARTH_RADIUS * math.pi / 180
+
+def _haversine(lat1, lng1, lat2, lng2):
+    """ Returns the great circle distance between two points, in miles. """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * 
+         math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex(object):
+    """
+    A grid index over the postcodes of a `LocalDataset`, which answers 
+    nearest neighbour queries in-process. Postcodes are bucketed into 
+    square cells of `cell_size` degrees, and a query searches outwards 
+    from its own cell, ring by ring, until no unsearched cell can hold 
+    a nearer postcode. Queries far from the data, where the rings would 
+    hold more cells than there are postcode cells, instead search the 
+    postcode cells in order of their distance. Distances are exact great 
+    circle distances.
+
+    :param dataset: the `LocalDataset` to index.
+
+    :param cell_size: size of the grid's cells, in degrees.
+    """
+
+    def __init__(self, dataset, cell_size=0.01):
+        self.dataset = dataset
+        self.cell_size = cell_size
+        cells = {}
+        lats, lngs = dataset._lat, dataset._lng
+        for i in range(len(dataset)):
+            cells.setdefault(self._cell(lats[i], lngs[i]), []).append(i)
+        self._cells = dict((cell, array.array('i', rows)) 
+                           for cell, rows in cells.items())
+        if cells:
+            ys, xs = zip(*cells)
+            self._extent = min(ys), max(ys), min(xs), max(xs)
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)), 
+                int(math.floor(lng / self.cell_size)))
+
+    def _ring(self, y, x, r):
+        """ Yields the cells at a Chebyshev distance of `r` from (y, x). """
+        if r == 0:
+            yield y, x
+            return
+        for dx in range(-r, r + 1):
+            yield y - r, x + dx
+            yield y + r, x + dx
+        for dy in range(-r + 1, r):
+            yield y + dy, x - r
+            yield y + dy, x + r
+
+    def _bound(self, lat, r, best):
+        """ 
+        Returns a lower bound on the distance from `lat` to any postcode 
+        more than `r` rings away, given that postcodes further than 
+        `best` miles away are of no interest.
+        """
+        delta = math.radians(r * self.cell_size)
+        lat_bound = r * self.cell_size * _MILES_PER_DEGREE
+        phi = math.radians(min(90.0, abs(lat) + best / _MILES_PER_DEGREE))
+        lng_bound = 2 * _EARTH_RADIUS * math.asin(
+            min(1.0, math.cos(phi) * math.sin(min(delta, math.pi) / 2)))
+        return min(lat_bound, lng_bound)
+
+    def _cell_bound(self, lat0, lat1, lng0, lng1, cell):
+        """
+        Returns a lower bound on the distance between any point with a 
+        latitude in [`lat0`, `lat1`] and longitude in [`lng0`, `lng1`], 
+        and any point in `cell`.
+        """
+        size = self.cell_size
+        cell_lat0, cell_lng0 = cell[0] * size, cell[1] * size
+        cell_lat1, cell_lng1 = cell_lat0 + size, cell_lng0 + size
+        lat_gap = max(0.0, cell_lat0 - lat1, lat0 - cell_lat1)
+        if cell_lng0 <= lng1 and lng0 <= cell_lng1:
+            lng_gap = 0.0
+        else:
+            lng_gap = min((cell_lng0 - lng1) % 360, (lng0 - cell_lng1) % 360, 
+                          180.0)
+        phi = math.radians(min(90.0, max(abs(lat0), abs(lat1), 
+                                         abs(cell_lat0), abs(cell_lat1))))
+        lng_bound = 2 * _EARTH_RADIUS * math.asin(
+            min(1.0, math.cos(phi) * math.sin(math.radians(lng_gap) / 2)))
+        return max(lat_gap * _MILES_PER_DEGREE, lng_bound)
+
+    def _cells_by_bound(self, lat0, lat1, lng0, lng1):
+        """ 
+        Returns a heap of (lower bound, cell) of every cell, for the 
+        points within the given bounds.
+        """
+        cells = [(self._cell_bound(lat0, lat1, lng0, lng1, cell), cell) 
+                 for cell in self._cells]
+        heapq.heapify(cells)
+        return cells
+
+    def _search(self, lat, lng, k):
+        """ Returns a sorted list of (distance, row) of the k nearest rows. """
+        if not self._cells:
+            return []
+        y, x = self._cell(lat, lng)
+        min_y, max_y, min_x, max_x = self._extent
+        # rings nearer than the extent of the data are all empty
+        r = max(0, min_y - y, y - max_y, min_x - x, x - max_x)
+        r_max = max(abs(y - min_y), abs(y - max_y), 
+                    abs(x - min_x), abs(x - max_x))
+        lats, lngs, best = self.dataset._lat, self.dataset._lng, []
+        visited = 0
+        while r <= r_max:
+            visited += 8 * r or 1
+            if visited > len(self._cells):
+                return self._scan(lat, lng, k)
+            for cell in self._ring(y, x, r):
+                for i in self._cells.get(cell, ()):
+                    dist = _haversine(lat, lng, lats[i], lngs[i])
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, i))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, i))
+            if len(best) == k and -best[0][0] <= self._bound(lat, r, 
+                                                             -best[0][0]):
+                break
+            r += 1
+        return sorted((-dist, i) for dist, i in best)
+
+    def _scan(self, lat, lng, k):
+        """ 
+        Like `_search`, but visits the postcode cells in order of their 
+        distance from the point, rather than ring by ring.
+        """
+        lats, lngs, best = self.dataset._lat, self.dataset._lng, []
+        cells = self._cells_by_bound(lat, lat, lng, lng)
+        while cells:
+            bound, cell = heapq.heappop(cells)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            for i in self._cells[cell]:
+                dist = _haversine(lat, lng, lats[i], lngs[i])
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, i))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, (-dist, i))
+        return sorted((-dist, i) for dist, i in best)
+
+    def nearest(self, lat, lng, k=1):
+        """
+        Finds the `k` postcodes nearest to a geographical point.
+
+        :returns: a list of up to `k` tuples of a postcode's data and 
+                  its distance in miles, nearest first.
+        """
+        _check_point(lat, lng)
+        return [(self.dataset._record(i), dist) 
+                for dist, i in self._search(lat, lng, k)]
+
+    def k_nearest(self, lats, lngs, k=1):
+        """
+        Finds the `k` postcodes nearest to each of many points, given as 
+        sequences of latitudes and longitudes.
+
+        :returns: a list with a list of `nearest` results for each point.
+        """
+        return [self.nearest(lat, lng, k) for lat, lng in zip(lats, lngs)]
+
+    def nearest_arrays(self, lats, lngs):
+        """
+        Finds the postcode nearest to each of many points, given as 
+        arrays of latitudes and longitudes. This requires NumPy, and 
+        works on whole arrays at once: points are validated in a single 
+        pass, and points in the same grid cell are searched together, 
+        so it's much faster than `nearest` for large batches.
+
+        :raises IllegalPointException: if any latitude or longitude is 
+                                       out of bounds.
+
+        :returns: a tuple of an array of the nearest postcodes and an 
+                  array of their distances in miles.
+        """
+        np = _numpy()
+        if np is None:
+            raise ImportError("nearest_arrays requires NumPy")
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lngs = np.asarray(lngs, dtype=np.float64).ravel()
+        if lats.shape != lngs.shape:
+            raise ValueError("lats and lngs must have the same length")
+        illegal = ~((np.abs(lats) <= 90) & (np.abs(lngs) <= 180))
+        if illegal.any():
+            i = np.argmax(illegal)
+            raise IllegalPointException(
+                "Illegal lat and/or lng, (%s, %s) provided." % 
+                (lats[i], lngs[i]))
+        rows = np.full(len(lats), -1, dtype=np.intp)
+        dists = np.full(len(lats), np.nan)
+        if not self._cells or not len(lats):
+            return np.full(len(lats), '', dtype='U8'), dists
+        ys = np.floor(lats / self.cell_size).astype(np.int64)
+        xs = np.floor(lngs / self.cell_size).astype(np.int64)
+        cells, groups = np.unique(np.stack([ys, xs], axis=1), axis=0, 
+                                  return_inverse=True)
+        order = np.argsort(groups.ravel(), kind='stable')
+        ends = np.cumsum(np.bincount(groups.ravel(), minlength=len(cells)))
+        for (y, x), end, size in zip(cells.tolist(), ends, 
+                                     np.diff(ends, prepend=0)):
+            points = order[end - size:end]
+            rows[points], dists[points] = self._search_group(
+                np, int(y), int(x), lats[points], lngs[points])
+        keys = np.frombuffer(self.dataset._keys, dtype='S%d' % 
+                             self.dataset._width)
+        found, inverse = np.unique(rows, return_inverse=True)
+        names = np.array([self.dataset._format(k) for k in keys[found]])
+        return names[inverse.ravel()], dists
+
+    def _search_group(self, np, y, x, lats, lngs):
+        """ 
+        The vectorised equivalent of `_search` for points which are all 
+        in cell (y, x), returning their nearest rows and distances.
+        """
+        min_y, max_y, min_x, max_x = self._extent
+        r = max(0, min_y - y, y - max_y, min_x - x, x - max_x)
+        r_max = max(abs(y - min_y), abs(y - max_y), 
+                    abs(x - min_x), abs(x - max_x))
+        best = np.full(len(lats), np.inf)
+        rows = np.full(len(lats), -1, dtype=np.intp)
+        max_lat = np.abs(lats).max()
+        visited = 0
+        while r <= r_max:
+            visited += 8 * r or 1
+            if visited > len(self._cells):
+                return self._scan_group(np, y, x, lats, lngs)
+            ring = [self._cells[cell] for cell in self._ring(y, x, r) 
+                    if cell in self._cells]
+            if ring:
+                self._nearer(np, lats, lngs, ring, best, rows)
+            worst = best.max()
+            if worst < np.inf and worst <= self._bound(max_lat, r, worst):
+                break
+            r += 1
+        return rows, best
+
+    def _scan_group(self, np, y, x, lats, lngs, batch=64):
+        """ 
+        Like `_search_group`, but visits the postcode cells in batches, 
+        in order of their distance from cell (y, x).
+        """
+        size = self.cell_size
+        best = np.full(len(lats), np.inf)
+        rows = np.full(len(lats), -1, dtype=np.intp)
+        cells = self._cells_by_bound(y * size, (y + 1) * size, 
+                                     x * size, (x + 1) * size)
+        while cells and cells[0][0] <= best.max():
+            ring = [self._cells[heapq.heappop(cells)[1]] 
+                    for _ in range(min(batch, len(cells)))]
+            self._nearer(np, lats, lngs, ring, best, rows)
+        return rows, best
+
+    def _nearer(self, np, lats, lngs, cells, best, rows):
+        """ 
+        Updates the `best` distances and nearest `rows` of each point 
+        with the postcodes in `cells`.
+        """
+        all_lats, all_lngs = self.dataset._arrays()
+        candidates = np.concatenate(
+            [np.frombuffer(c, dtype=np.int32) for c in cells])
+        dist = _np_haversine(np, lats[:, None], lngs[:, None],
+                             all_lats[candidates][None, :],
+                             all_lngs[candidates][None, :])
+        nearest = dist.argmin(axis=1)
+        nearest_dist = dist[np.arange(len(lats)), nearest]
+        better = nearest_dist < best
+        best[better] = nearest_dist[better]
+        rows[better] = candidates[nearest[better]]
+
+    def _box(self, lat, lng, distance):
+        """ 
+        Returns the rows in the cells overlapping a bounding box which 
+        contains every point within `distance` miles of (`lat`, `lng`).
+        """
+        if not self._cells:
+            return []
+        min_y, max_y, min_x, max_x = self._extent
+        dlat = distance / _MILES_PER_DEGREE
+        phi = math.radians(min(90.0, abs(lat) + dlat))
+        arg = math.sin(distance / (2 * _EARTH_RADIUS)) / max(math.cos(phi), 
+                                                             1e-12)
+        if arg >= 1: # the box contains a pole, so spans every longitude
+            x0, x1 = min_x, max_x
+        else:
+            dlng = math.degrees(2 * math.asin(arg))
+            x0, x1 = (self._cell(0, lng - dlng)[1], 
+                      self._cell(0, lng + dlng)[1])
+        y0, y1 = self._cell(lat - dlat, 0)[0], self._cell(lat + dlat, 0)[0]
+        y0, y1, x0, x1 = (max(y0, min_y), min(y1, max_y), 
+                          max(x0, min_x), min(x1, max_x))
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self._cells):
+            cells = [rows for (y, x), rows in self._cells.items() 
+                     if y0 <= y <= y1 and x0 <= x <= x1]
+        else:
+            cells = [self._cells.get((y, x), ()) for y in range(y0, y1 + 1) 
+                     for x in range(x0, x1 + 1)]
+        return [i for rows in cells for i in rows]
+
+    def _distances(self, lat, lng, rows):
+        """ Returns the distances from a point to each of `rows`. """
+        np = _numpy()
+        if np is None:
+            lats, lngs = self.dataset._lat, self.dataset._lng
+            return [_haversine(lat, lng, lats[i], lngs[i]) for i in rows]
+        rows = np.asarray(rows, dtype=np.intp)
+        lats, lngs = self.dataset._arrays()
+        return _np_haversine(np, lat, lng, lats[rows], lngs[rows]).tolist()
+
+    def within(self, lat, lng, distance, limit=None):
+        """
+        Finds the postcodes within `distance` miles of a geographical 
+        point. Candidates are found from the cells overlapping a 
+        bounding box around the point, and their distances are then 
+        computed with NumPy, if it's installed.
+
+        :param limit: optional maximum number of postcodes to return.
+
+        :returns: a list of tuples of a postcode's data and its distance 
+                  in miles, nearest first.
+        """
+        _check_point(lat, lng)
+        _check_distance(distance)
+        rows = self._box(lat, lng, distance)
+        found = [(dist, i) for dist, i in 
+                 zip(self._distances(lat, lng, rows), rows) 
+                 if dist <= distance]
+        if limit is not None:
+            found = heapq.nsmallest(limit, found)
+        else:
+            found.sort()
+        return [(self.dataset._record(i), dist) for dist, i in found]
+
+
+def _numpy():
+    """ Returns the numpy module, or None if it isn't installed. """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _np_haversine(np, lat, lng, lats, lngs):
+    """ Vectorised `_haversine` from one point to arrays of points. """
+    lat, lng, lats, lngs = (np.radians(lat), np.radians(lng), 
+                            np.radians(lats), np.radians(lngs))
+    a = (np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * 
+         np.sin((lngs - lng) / 2) ** 2)
+    return 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _imap_bounded(fun, items, max_workers, ordered=True, inline=None):
+    """
+    Yields ``fun(item)`` for each item of `items`, calling `fun` in a 
+    pool of `max_workers` threads. Items for which ``inline(item)`` is 
+    true are called directly instead. Only a small window of items is 
+    in progress at once, so `items` may be arbitrarily long.
+
+    Results are yielded in the order of `items` if `ordered` is true, 
+    otherwise in the order they complete.
+    """
+    from concurrent.futures import Future, ThreadPoolExecutor, wait, \
+                                   FIRST_COMPLETED
+    window, limit = deque(), 2 * max_workers
+
+    def completed(block):
+        """ Pops finished results, waiting for one if `block` is true. """
+        if ordered:
+            while window and (block or window[0].done()):
+                block = False
+                yield window.popleft().result()
+            return
+        done = [future for future in window if future.done()]
+        if not done and block:
+            done, _ = wait(window, return_when=FIRST_COMPLETED)
+        for future in done:
+            window.remove(future)
+            yield future.result()
+
+    pool = ThreadPoolExecutor(max_workers)
+    try:
+        for item in items:
+            if inline is not None and inline(item):
+                future = Future()
+                future.set_result(fun(item))
+            else:
+                future = pool.submit(fun, item)
+            window.append(future)
+            for result in completed(len(window) >= limit):
+                yield result
+        while window:
+            for result in completed(True):
+                yield result
+    finally:
+        for future in window:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+_AREAS = {} # shared, de-duplicated administrative area tuples
+#: The number of area tuples `_AREAS` holds before it's emptied.
+_AREAS_LIMIT = 65536
+_AREA_NAMES = (('district', 'snac'), ('ward', 'snac'), 
+               ('constituency', 'code'))
+_GEO_NAMES = frozenset(['lat', 'lng', 'easting', 'northing', 'geohash'])
+
+
+def _shared(areas):
+    """ 
+    Returns the shared copy of the administrative area tuple `areas`. 
+    The table of them is emptied when it's full, so it can't grow 
+    without limit as the records using them are evicted from caches.
+    """
+    shared = _AREAS.get(areas)
+    if shared is None:
+        if len(_AREAS) >= _AREAS_LIMIT:
+            _AREAS.clear()
+        shared = _AREAS.setdefault(areas, areas)
+    return shared
+
+def _coordinate(value):
+    """ 
+    Returns the latitude or longitude string `value` as a float if 
+    formatting the float with six decimal places gives `value` back, 
+    otherwise `value` itself.
+    """
+    if not isinstance(value, str) and not isinstance(value, type(u'')):
+        raise TypeError("%r is not a string" % (value,))
+    number = float(value)
+    return number if '%.6f' % number == value else value
+
+
+class PostcodeRecord(Mapping):
+    """
+    A compact, read-only representation of a postcode's data, which 
+    behaves like the dict returned by the web-service. Latitude and 
+    longitude are stored as floats when they are in the service's six 
+    decimal place format, so they convert back to exactly the same 
+    strings, and otherwise as they were. Administrative areas are shared 
+    between all the records in the same areas; the nested dicts are 
+    only built when they are accessed. Use `to_dict` to get a plain 
+    dict.
+
+    Records are created with `PostcodeRecord.from_dict`, and are used 
+    by a `PostCoder` created with ``compact=True``.
+    """
+    __slots__ = ('postcode', 'lat', 'lng', 'easting', 'northing', 
+                 'geohash', 'areas', 'distance')
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Returns a record of the postcode data `data`, or `data` itself if 
+        it has any fields a record can't represent.
+        """
+        try:
+            geo, admin = data['geo'], data['administrative']
+            if (set(data) - set(['postcode', 'geo', 'administrative', 
+                                 'distance']) or set(geo) - _GEO_NAMES or 
+                    len(admin) != len(_AREA_NAMES)):
+                return data
+            areas = []
+            for name, code_name in _AREA_NAMES:
+                area = admin[name]
+                if set(area) != set([code_name, 'title', 'uri']):
+                    return data
+                area = (area[code_name], area['title'], area['uri'])
+                areas.append(_shared(area))
+            areas = tuple(areas)
+            record = cls()
+            record.postcode = data['postcode']
+            record.lat = _coordinate(geo['lat'])
+            record.lng = _coordinate(geo['lng'])
+            record.easting = geo.get('easting')
+            record.northing = geo.get('northing')
+            record.geohash = geo.get('geohash')
+            record.areas = _shared(areas)
+            record.distance = data.get('distance')
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return data
+        return record
+
+    def _geo(self):
+        geo = dict((name, '%.6f' % value if isinstance(value, float) 
+                            else value) 
+                   for name, value in (('lat', self.lat), ('lng', self.lng)))
+        for name in ('easting', 'northing', 'geohash'):
+            if getattr(self, name) is not None:
+                geo[name] = getattr(self, name)
+        return geo
+
+    def _administrative(self):
+        return dict((name, {code_name: area[0], 'title': area[1], 
+                            'uri': area[2]}) 
+                    for (name, code_name), area in 
+                    zip(_AREA_NAMES, self.areas))
+
+    def _fields(self):
+        if self.distance is None:
+            return ('postcode', 'geo', 'administrative')
+        return ('postcode', 'geo', 'administrative', 'distance')
+
+    def __getitem__(self, key):
+        if key == 'postcode':
+            return self.postcode
+        if key == 'geo':
+            return self._geo()
+        if key == 'administrative':
+            return self._administrative()
+        if key == 'distance' and self.distance is not None:
+            return self.distance
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields())
+
+    def __len__(self):
+        return len(self._fields())
+
+    def __repr__(self):
+        return 'PostcodeRecord(%r)' % self.to_dict()
+
+    def to_dict(self):
+        """ Returns the record's data as a plain dict. """
+        return dict((key, self[key]) for key in self)
+
+
+def _compact(result):
+    """ Converts postcode data, or a list of it, to `PostcodeRecord`s. """
+    if isinstance(result, dict):
+        return PostcodeRecord.from_dict(result)
+    if isinstance(result, list):
+        return [_compact(item) for item in result]
+    return result
+
+def _to_json(obj):
+    if isinstance(obj, PostcodeRecord):
+        return obj.to_dict()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _filter_radius(results, distance, point=None):
+    """
+    Returns the radius search `results` which are within `distance`, or 
+    `_MISSING` if any result's distance can't be determined.
+    """
+    if results is None:
+        return None
+    filtered = []
+    for result in results:
+        try:
+            if 'distance' in result:
+                dist = float(result['distance'])
+            elif point is not None:
+                geo = result.get('geo', result)
+                dist = _haversine(point[0], point[1], float(geo['lat']), 
+                                  float(geo['lng']))
+            else:
+                return _MISSING
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return _MISSING
+        if dist <= distance:
+            filtered.append(result)
+    return filtered
+
+
+class _Call(object):
+    """ An in-flight request, which other threads can wait on. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+BulkResult = namedtuple('BulkResult', 'postcode result error')
+BulkResult.__doc__ = """
+A result yielded by `PostCoder.get_many`. `postcode` is the normalised 
+postcode, and `error` is the exception raised looking it up, if any, in 
+which case `result` is None.
+"""
+
 
 class PostCoder(object):
     """
@@ -110,30 +2174,318 @@ class PostCoder(object):
     your application. 
 
     Because the underlying data is not likely to change very much, if 
-    at all, cached postcode data never expires. However, if for some 
-    perverse reason you do want to skip the cache and make an explicit 
-    request for data then you can set ``skip_cache=True`` in all of the 
-    available methods. 
+    at all, by default cached postcode data never expires. However, if 
+    for some perverse reason you do want to skip the cache and make an 
+    explicit request for data then you can set ``skip_cache=True`` in 
+    all of the available methods. 
+
+    Long-running processes which see many distinct postcodes should 
+    provide a bounded cache, such as an `LRUCache` or `TTLCache`, so 
+    that memory use stays flat. A `SQLiteCache` can be shared between 
+    processes and survives restarts.
+
+    :param cache: optional cache to store responses in. Defaults to an 
+                  unbounded ``dict``.
+
+    :param transport: optional `Transport` to make requests with. By 
+                      default all `PostCoder` objects share a transport.
 
+    :param dataset: optional `LocalDataset` to answer all lookups from 
+                    instead of the web-service. Local lookups are fast 
+                    enough that they aren't cached.
+
+    :param geo_precision: optional number of decimal places to round 
+                          the points of `get_from_geo` searches to, so 
+                          that searches around nearly identical points 
+                          share cached results.
+
+    :param compact: if true, responses are cached and returned as 
+                    `PostcodeRecord` objects, which use a fraction of the 
+                    memory of the web-service's dicts.
+
+    :param negative_cache: optional cache for lookups which found no 
+                           data. Defaults to a `TTLCache` of up to 10,000 
+                           results which expire after an hour, so that 
+                           unknown postcodes don't fill `cache`.
+
+    :param prefetch_distance: optional distance in miles. Once 
+                              `prefetch_after` uncached postcodes in the 
+                              same sector (such as ``W1A 1``) have been 
+                              looked up, the postcodes within this 
+                              distance of the last one are fetched with 
+                              a single `get_from_postcode` request in 
+                              the background and cached, so that later 
+                              lookups nearby are cache hits. At most 
+                              `PREFETCH_WORKERS` prefetches run at once; 
+                              others are dropped, and their sectors can 
+                              become worth prefetching again.
+
+    :param prefetch_after: number of uncached lookups in a sector which 
+                           make it worth prefetching.
+
+    :param nearest_precision: optional number of characters of the 
+                              geohash cells which `get_nearest` results 
+                              are also cached by. A later search from 
+                              elsewhere in the same cell is answered 
+                              from the cache if the cached postcode is 
+                              provably no more than `nearest_tolerance` 
+                              further away than the nearest postcode. 
+                              7 characters give cells of about 150m.
+
+    :param nearest_tolerance: the distance in miles by which a cached 
+                              postcode may be further away than the 
+                              nearest one.
     """
 
-    def __init__(self):
-        self.cache = {}
+    #: The number of sectors whose lookups are counted for prefetching.
+    PREFETCH_SECTORS = 1024
+
+    #: The number of prefetches which may run at once.
+    PREFETCH_WORKERS = 2
+
+    def __init__(self, cache=None, transport=None, dataset=None,
+                 geo_precision=None, compact=False, negative_cache=None,
+                 prefetch_distance=None, prefetch_after=2,
+                 nearest_precision=None, nearest_tolerance=0.01):
+        self.cache = {} if cache is None else cache
+        self.negative_cache = TTLCache(3600, max_entries=10000) \
+                              if negative_cache is None else negative_cache
+        self.transport = transport
+        self.dataset = dataset
+        self.geo_precision = geo_precision
+        self.compact = compact
+        self.prefetch_distance = prefetch_distance
+        self.prefetch_after = prefetch_after
+        self.nearest_precision = nearest_precision
+        self.nearest_tolerance = nearest_tolerance
+        self._lock = threading.Lock()
+        self._inflight = {} # cache key -> _Call
+        self._sectors = OrderedDict() # sector -> misses, None if prefetched
+        self._prefetchers = threading.BoundedSemaphore(self.PREFETCH_WORKERS)
 
     def _check_point(self, lat, lng):
         """ Checks if latitude and longitude correct """
-        if abs(lat) > 90 or abs(lng) > 180:
-            msg = "Illegal lat and/or lng, (%s, %s) provided." % (lat, lng)
-            raise IllegalPointException(msg)
+        _check_point(lat, lng)
+
+    def _cached(self, key, count=True):
+        """ 
+        Returns the cached response for `key`, which may be a cached 
+        negative result (None), or `_MISSING`.
+
+        :param count: optional argument specifying whether to count the 
+                      lookup in the cache metrics.
+        """
+        metrics = _metrics if count else None
+        result = self.cache.get(key, _MISSING)
+        if result is not _MISSING:
+            if metrics is not None:
+                metrics.count('cache.hits')
+            return result
+        if self.negative_cache.get(key, _MISSING) is None:
+            if metrics is not None:
+                metrics.count('cache.negative_hits')
+            return None
+        if metrics is not None:
+            metrics.count('cache.misses')
+        return _MISSING
+
+    def _store(self, key, result):
+        """ Caches `result`, in the negative cache if it's None. """
+        cache, stale = self.cache, self.negative_cache
+        if result is None:
+            cache, stale = stale, cache
+        cache[key] = result
+        try:
+            del stale[key]
+        except KeyError:
+            pass
 
     def _lookup(self, skip_cache, fun, *args, **kwargs):
         """ 
         Checks for cached responses, before requesting from 
-        web-service
+        web-service. Concurrent requests for the same data are 
+        coalesced, so only one thread makes the request and the others 
+        wait for its result. The cache is only read and written outside 
+        `_lock`, so a slow cache doesn't hold up other lookups.
         """
-        if args not in self.cache or skip_cache:
-            self.cache[args] = fun(*args, **kwargs)
-        return self.cache[args]
+        if self.transport is not None:
+            kwargs.setdefault('transport', self.transport)
+        if not skip_cache:
+            result = self._cached(args)
+            if result is not _MISSING:
+                return result
+        with self._lock:
+            call = self._inflight.get(args)
+            leader = call is None
+            if leader:
+                call = self._inflight[args] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            # a leader which finished since the cache was read stored its 
+            # result before leaving _inflight
+            result = _MISSING if skip_cache else \
+                     self._cached(args, count=False)
+            if result is not _MISSING:
+                call.result = result
+            else:
+                call.result = fun(*args, **kwargs)
+                if self.compact:
+                    call.result = _compact(call.result)
+                self._store(args, call.result)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[args]
+            call.done.set()
+        return call.result
+
+    def _hot(self, postcode):
+        """
+        Counts an uncached lookup of `postcode`, and reports whether its 
+        sector has just become worth prefetching. Each sector is only 
+        prefetched once while its lookups are counted.
+        """
+        sector = postcode[:-2]
+        with self._lock:
+            misses = self._sectors.pop(sector, 0)
+            hot = misses is not None and misses + 1 >= self.prefetch_after
+            self._sectors[sector] = None if hot or misses is None \
+                                    else misses + 1
+            if len(self._sectors) > self.PREFETCH_SECTORS:
+                self._sectors.popitem(last=False)
+            return hot
+
+    def _prefetch(self, postcode):
+        """
+        Caches the postcodes within `prefetch_distance` of `postcode` in 
+        a background thread, unless `PREFETCH_WORKERS` are already 
+        running, when it returns None. Results which aren't complete 
+        postcode data, and postcodes which are already cached, are 
+        skipped.
+        """
+        if not self._prefetchers.acquire(False):
+            if _metrics is not None:
+                _metrics.count('prefetch.dropped')
+            sector = postcode[:-2]
+            with self._lock:
+                if sector in self._sectors:
+                    self._sectors[sector] = 0
+            return None
+
+        def prefetch():
+            count = 0
+            try:
+                for result in get_from_postcode(postcode, 
+                                                self.prefetch_distance,
+                                                self.transport, stream=True):
+                    if not isinstance(result, dict) or \
+                            'postcode' not in result or \
+                            'geo' not in result or \
+                            'administrative' not in result:
+                        continue
+                    result = dict(result)
+                    result.pop('distance', None)
+                    key = (_normalise_postcode(result['postcode']),)
+                    if self.compact:
+                        result = _compact(result)
+                    if key in self.cache:
+                        continue
+                    with self._lock:
+                        busy = key in self._inflight
+                    if not busy:
+                        self._store(key, result)
+                        count += 1
+            except Exception:
+                pass # prefetching is only speculative
+            finally:
+                self._prefetchers.release()
+            if _metrics is not None:
+                _metrics.count('prefetch.records', count)
+
+        if _metrics is not None:
+            _metrics.count('prefetch.requests')
+        thread = threading.Thread(target=prefetch, name='postcodes-prefetch')
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            self._prefetchers.release()
+            raise
+        return thread
+
+    def _cached_nearest(self, lat, lng):
+        """
+        Returns the cached nearest postcode to a point in the same 
+        geohash cell as (`lat`, `lng`), if it's within 
+        `nearest_tolerance` of being the nearest postcode to 
+        (`lat`, `lng`) too, otherwise `_MISSING`.
+        """
+        entry = self.cache.get(('~nearest', _geohash(lat, lng, 
+                                                     self.nearest_precision)))
+        if entry is None:
+            return _MISSING
+        lat0, lng0, dist0, postcode, plat, plng = entry
+        # no postcode was nearer than dist0 to (lat0, lng0), so none can 
+        # be nearer than dist0 - moved to (lat, lng)
+        moved = _haversine(lat, lng, lat0, lng0)
+        if _haversine(lat, lng, plat, plng) - (dist0 - moved) > \
+                self.nearest_tolerance:
+            return _MISSING
+        result = self.cache.get((postcode,), _MISSING)
+        if result is not _MISSING and _metrics is not None:
+            _metrics.count('cache.nearest_hits')
+        return result
+
+    def _store_nearest(self, lat, lng, result):
+        """
+        Records `result` as the nearest postcode to (`lat`, `lng`) for 
+        its geohash cell, and caches it as that postcode's data.
+        """
+        try:
+            plat, plng = float(result['geo']['lat']), \
+                         float(result['geo']['lng'])
+            postcode = _normalise_postcode(result['postcode'])
+        except (KeyError, TypeError, ValueError):
+            return
+        entry = (lat, lng, _haversine(lat, lng, plat, plng), postcode, 
+                 plat, plng)
+        self.cache[('~nearest', _geohash(lat, lng, 
+                                         self.nearest_precision))] = entry
+        if (postcode,) not in self.cache:
+            self._store((postcode,), result)
+
+    def _radius_lookup(self, skip_cache, fun, centre, distance, point=None):
+        """
+        Like `_lookup`, for searches within `distance` of `centre`. The 
+        largest cached search around each centre is also recorded, so 
+        smaller searches around the same centre can be answered by 
+        filtering its results.
+
+        :param point: the (lat, lng) of `centre`, if known, which is used 
+                      to measure results which have no ``distance``.
+        """
+        largest_key = ('~radius',) + centre
+        if not skip_cache:
+            largest = self.cache.get(largest_key)
+            if largest is not None and largest > distance:
+                cached = self._cached(centre + (largest,))
+                if cached is not _MISSING:
+                    result = _filter_radius(cached, distance, point)
+                    if result is not _MISSING:
+                        return result
+        result = self._lookup(skip_cache, fun, *(centre + (distance,)))
+        # racing updates can record a smaller search than the largest, 
+        # which only means fewer searches are answered from the cache
+        largest = self.cache.get(largest_key)
+        if largest is None or distance > largest:
+            self.cache[largest_key] = distance
+        return result
 
     def get(self, postcode, skip_cache=False):
         """
@@ -144,10 +2496,23 @@ class PostCoder(object):
                            Given postcode data doesn't really change, 
                            it's unlikely you will ever want to set this 
                            to `True`.
+
+        :returns: a dict of the postcode's data, or None if there is no 
+                  data for it. Postcodes which aren't in a valid format 
+                  return None without a request being made.
         """
+        if not is_valid_postcode(postcode):
+            return None
+        if self.dataset is not None:
+            return self.dataset.get(postcode)
         # remove spaces and change case here due to caching
-        postcode = postcode.lower().replace(' ', '')
-        return self._lookup(skip_cache, get, postcode)
+        postcode = _normalise_postcode(postcode)
+        missed = self.prefetch_distance is not None and not skip_cache and \
+                 (postcode,) not in self.cache
+        result = self._lookup(skip_cache, get, postcode)
+        if missed and result is not None and self._hot(postcode):
+            self._prefetch(postcode)
+        return result
 
     def get_nearest(self, lat, lng, skip_cache=False): 
         """
@@ -164,9 +2529,37 @@ class PostCoder(object):
         """
         lat, lng = float(lat), float(lng)
         self._check_point(lat, lng)
-        return self._lookup(skip_cache, get_nearest, lat, lng)
+        if self.dataset is not None:
+            return self.dataset.nearest(lat, lng)
+        if self.nearest_precision is None:
+            return self._lookup(skip_cache, get_nearest, lat, lng)
+        if not skip_cache:
+            result = self._cached_nearest(lat, lng)
+            if result is not _MISSING:
+                return result
+        result = self._lookup(skip_cache, get_nearest, lat, lng)
+        self._store_nearest(lat, lng, result)
+        return result
 
-    def get_from_postcode(self, postcode, distance, skip_cache=False):
+    def get_nearest_many(self, lats, lngs):
+        """
+        Finds the nearest postcode to each of many points, given as 
+        arrays of latitudes and longitudes, with 
+        `SpatialIndex.nearest_arrays`. This requires a dataset and 
+        NumPy.
+
+        :raises IllegalPointException: if any latitude or longitude is 
+                                       out of bounds.
+
+        :returns: a tuple of an array of the nearest postcodes and an 
+                  array of their distances in miles.
+        """
+        if self.dataset is None:
+            raise ValueError("get_nearest_many requires a LocalDataset")
+        return self.dataset.spatial.nearest_arrays(lats, lngs)
+
+    def get_from_postcode(self, postcode, distance, skip_cache=False,
+                          stream=False):
         """
         Calls `postcodes.get_from_postcode` but checks correctness of 
         `distance`, and by default utilises a local cache.
@@ -174,6 +2567,10 @@ class PostCoder(object):
         :param skip_cache: optional argument specifying whether to skip 
                            the cache and make an explicit request.
 
+        :param stream: if true, return an iterator of the results as they 
+                       are received, like `postcodes.get_from_postcode`. 
+                       Streamed results are not cached.
+
         :raises IllegalPointException: if the latitude or longitude 
                                        are out of bounds.
 
@@ -181,14 +2578,21 @@ class PostCoder(object):
                   specified distance.
         """
         distance = float(distance)
-        if distance < 0:
-            raise IllegalDistanceException("Distance must not be negative")
+        _check_distance(distance)
+        if not is_valid_postcode(postcode):
+            return iter(()) if stream else None
+        if stream:
+            return get_from_postcode(postcode, distance, self.transport, 
+                                     self.dataset, stream=True)
+        if self.dataset is not None:
+            return self.dataset.within_postcode(postcode, distance)
         # remove spaces and change case here due to caching
-        postcode = postcode.lower().replace(' ', '')
-        return self._lookup(skip_cache, get_from_postcode, postcode, 
-                            float(distance))
+        postcode = _normalise_postcode(postcode)
+        return self._radius_lookup(skip_cache, get_from_postcode, 
+                                   (postcode,), distance)
 
-    def get_from_geo(self, lat, lng, distance, skip_cache=False):
+    def get_from_geo(self, lat, lng, distance, skip_cache=False, 
+                     stream=False):
         """
         Calls `postcodes.get_from_geo` but checks the correctness of 
         all arguments, and by default utilises a local cache.
@@ -196,6 +2600,10 @@ class PostCoder(object):
         :param skip_cache: optional argument specifying whether to skip 
                            the cache and make an explicit request.
 
+        :param stream: if true, return an iterator of the results as they 
+                       are received, like `postcodes.get_from_geo`. 
+                       Streamed results are not cached.
+
         :raises IllegalPointException: if the latitude or longitude 
                                        are out of bounds.
 
@@ -204,9 +2612,445 @@ class PostCoder(object):
         """
         # remove spaces and change case here due to caching
         lat, lng, distance = float(lat), float(lng), float(distance)
-        if distance < 0:
-            raise IllegalDistanceException("Distance must not be negative")
+        _check_distance(distance)
         self._check_point(lat, lng)
-        return self._lookup(skip_cache, get_from_geo, lat, lng, distance)
+        if stream:
+            return get_from_geo(lat, lng, distance, self.transport, 
+                                self.dataset, stream=True)
+        if self.dataset is not None:
+            return self.dataset.within(lat, lng, distance)
+        if self.geo_precision is not None:
+            lat = round(lat, self.geo_precision)
+            lng = round(lng, self.geo_precision)
+        return self._radius_lookup(skip_cache, get_from_geo, (lat, lng), 
+                                   distance, point=(lat, lng))
+
+    def get_many(self, postcodes, max_workers=8, ordered=True):
+        """
+        Looks up many postcodes concurrently, utilising the local cache.
+        Postcodes are normalised and each distinct postcode is looked up 
+        once, with cached postcodes served directly and the rest 
+        requested over a pool of `max_workers` threads.
+
+        `postcodes` may be any iterable, and is consumed lazily, so very 
+        large inputs can be streamed through. A failed lookup doesn't 
+        abort the batch; its error is reported in its result instead.
+
+        :param max_workers: maximum number of concurrent requests.
+
+        :param ordered: whether to yield results in the order postcodes 
+                        were given, or in the order they complete.
+
+        :returns: an iterator of `BulkResult` tuples, one per distinct 
+                  postcode.
+        """
+        def distinct():
+            seen = set()
+            for postcode in postcodes:
+                postcode = _normalise_postcode(postcode)
+                if postcode not in seen:
+                    seen.add(postcode)
+                    yield postcode
+
+        def lookup(postcode):
+            try:
+                return BulkResult(postcode, self.get(postcode), None)
+            except Exception as e:
+                return BulkResult(postcode, None, e)
+
+        cached = lambda postcode: (self.dataset is not None or 
+                                   not is_valid_postcode(postcode) or
+                                   (postcode,) in self.cache or
+                                   (postcode,) in self.negative_cache)
+        return _imap_bounded(lookup, distinct(), max_workers, ordered, 
+                             inline=cached)
+
+    def warm(self, postcodes, max_workers=4):
+        """
+        Looks up `postcodes` with `get_many` in a background thread, so 
+        that a new `PostCoder` can fill its cache with popular postcodes 
+        while serving other lookups. Lookups for postcodes which are 
+        being prefetched wait for the prefetch rather than making 
+        another request.
+
+        :param max_workers: maximum number of concurrent requests.
+
+        :returns: the started background thread, which may be joined to 
+                  wait for the warm-up to finish.
+        """
+        def warm():
+            for _ in self.get_many(postcodes, max_workers, ordered=False):
+                pass
+        thread = threading.Thread(target=warm, name='postcodes-warm')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def dump(self, f):
+        """
+        Writes a snapshot of the cached responses to the file object 
+        `f`, as lines of JSON, so that they can be loaded into another 
+        `PostCoder` with `load`. The cache must provide ``items()``, as 
+        ``dict`` and all of this module's caches do.
+
+        :returns: the number of responses written.
+        """
+        import json
+        count = 0
+        for key, value in list(self.cache.items()):
+            f.write(json.dumps([list(key), value], separators=(',', ':'),
+                               default=_to_json) + '\n')
+            count += 1
+        return count
+
+    def load(self, f):
+        """
+        Caches the responses from a snapshot written by `dump` to the 
+        file object `f`, replacing any cached responses for the same 
+        lookups.
+
+        :returns: the number of responses loaded.
+        """
+        import json
+        count = 0
+        for line in f:
+            if not line.strip():
+                continue
+            key, value = json.loads(line)
+            if self.compact:
+                value = _compact(value)
+            self._store(tuple(key), value)
+            count += 1
+        return count
+
+
+def make_server(host='127.0.0.1', port=8080, coder=None):
+    """
+    Makes a threaded HTTP server which answers requests in the same 
+    form as the web-service, from a `PostCoder`. Running one on each 
+    host and pointing its processes at it with `set_end_point` means 
+    they share a single cache, and the coalescing of concurrent 
+    requests and pool of connections of one `PostCoder`, rather than 
+    each requesting the same data. Start it with ``serve_forever()``, 
+    or run ``postcodes --serve``.
+
+    :param coder: optional `PostCoder` to answer requests with. Defaults 
+                  to one with an `LRUCache` of up to 100,000 responses.
+    """
+    import json
+    _import_http()
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import parse_qs
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        from urllib.parse import parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            coder = self.server.coder
+            url = urlsplit(self.path)
+            path = url.path
+            try:
+                if path.startswith('/postcode/') and path.endswith('.json'):
+                    result = coder.get(path[10:-5])
+                elif path.startswith('/latlng/') and path.endswith('.json'):
+                    lat, lng = path[8:-5].split(',')
+                    result = coder.get_nearest(lat, lng)
+                elif path == '/distance.php':
+                    query = dict((k, v[0]) for k, v in 
+                                 parse_qs(url.query).items())
+                    if 'postcode' in query:
+                        result = coder.get_from_postcode(query['postcode'], 
+                                                         query['distance'])
+                    else:
+                        result = coder.get_from_geo(query['lat'], 
+                                                    query['lng'],
+                                                    query['distance'])
+                else:
+                    return self.respond(404, b'')
+            except (KeyError, ValueError, IllegalPointException, 
+                    IllegalDistanceException) as e:
+                return self.respond(400, str(e).encode('utf-8'))
+            except ServiceException as e:
+                return self.respond(502, str(e).encode('utf-8'))
+            except Exception as e:
+                # still answer, so clients don't retry a broken server 
+                # as if the connection had failed
+                return self.respond(500, ('%s: %s' % (e.__class__.__name__, 
+                                                      e)).encode('utf-8'))
+            if result is None:
+                return self.respond(404, b'')
+            self.respond(200, json.dumps(result, separators=(',', ':'), 
+                                         default=_to_json).encode('utf-8'))
+
+        def respond(self, status, body):
+            self.send_response(status)
+            if len(body) > 512 and \
+                    'gzip' in self.headers.get('Accept-Encoding', ''):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 
+                                              16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Type', 'application/json' 
+                             if status == 200 else 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    server = Server((host, port), Handler)
+    server.coder = PostCoder(cache=LRUCache(max_entries=100000)) \
+                   if coder is None else coder
+    return server
+
+def set_end_point(url):
+    """
+    Sets the URL of the web-service that requests are made to, such as 
+    that of a server made by `make_server`. This applies to the module's 
+    functions and to every `PostCoder`.
+    """
+    global END_POINT
+    END_POINT = url.rstrip('/')
+
+
+#: The fields `main` adds to each CSV row from the postcode's data.
+CSV_FIELDS = ('postcode', 'lat', 'lng', 'easting', 'northing', 'district',
+              'ward', 'constituency', 'error')
+
+def _flatten(result):
+    """ Flattens postcode data into the `CSV_FIELDS` of a CSV row. """
+    if result is None:
+        return {}
+    geo = result.get('geo') or {}
+    admin = result.get('administrative') or {}
+    row = {'postcode': result.get('postcode')}
+    for name in ('lat', 'lng', 'easting', 'northing'):
+        row[name] = geo.get(name)
+    for name in ('district', 'ward', 'constituency'):
+        area = admin.get(name) or {}
+        row[name] = area.get('title') or area.get('snac') or area.get('code')
+    return row
+
+def _open_csv(path, mode):
+    """ Opens `path`, or stdin or stdout if it's ``-``, for the csv module. """
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+def _completed_rows(path, fmt):
+    """
+    Counts the complete rows already written to the output file `path`, 
+    removing any partly written row left by an interruption. The file 
+    is read in chunks, so this takes constant memory.
+    """
+    import csv
+    chunk = 65536
+    try:
+        with open(path, 'rb+') as f:
+            # search back from the end for the last complete row
+            f.seek(0, 2)
+            size = end = f.tell()
+            while end > 0:
+                start = max(end - chunk, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+    except IOError:
+        return 0
+    if fmt == 'jsonl':
+        with open(path, 'rb') as f:
+            return sum(data.count(b'\n') for data in 
+                       iter(lambda: f.read(chunk), b''))
+    with _open_csv(path, 'r') as f:
+        return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+
+def main(argv=None):
+    """
+    The ``postcodes`` command, which looks up every row of a CSV or 
+    JSON lines file with a `PostCoder`, by postcode or, given latitude 
+    and longitude columns, by the nearest postcode. Rows are streamed 
+    through a pool of workers and written out in their original order 
+    with the postcode's data added, so files of any size can be 
+    processed in constant memory. With ``--serve``, it runs a server 
+    made by `make_server` instead. Run ``postcodes --help`` for its 
+    options.
+    """
+    import argparse
+    import csv
+    import json
+    parser = argparse.ArgumentParser(
+        prog='postcodes', description="Looks up the postcodes, or nearest "
+        "postcodes to the points, in a CSV or JSON lines file.")
+    parser.add_argument('input', nargs='?', 
+                        help="input file, or - for stdin")
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file (default: stdout)")
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl'),
+                        help="file format (default: from the input file's "
+                        "extension, otherwise csv)")
+    parser.add_argument('--postcode-column', default='postcode',
+                        help="column of postcodes (default: postcode)")
+    parser.add_argument('--lat-column', 
+                        help="column of latitudes, to look up the nearest "
+                        "postcodes to points instead")
+    parser.add_argument('--lng-column', default='lng',
+                        help="column of longitudes (default: lng)")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="number of concurrent lookups (default: 8)")
+    parser.add_argument('--cache', 
+                        help="SQLite file to cache responses in across runs")
+    parser.add_argument('--dataset', 
+                        help="LocalDataset index to look postcodes up in "
+                        "instead of the web-service")
+    parser.add_argument('--rate', type=float,
+                        help="maximum requests per second (default: no "
+                        "limit)")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the rows already in the output file and "
+                        "append the rest")
+    parser.add_argument('--progress', type=float, default=5, metavar='SECS',
+                        help="seconds between progress reports on stderr, "
+                        "or 0 for none (default: 5)")
+    parser.add_argument('--serve', metavar='[HOST:]PORT',
+                        help="serve lookups over HTTP instead of reading a "
+                        "file")
+    args = parser.parse_args(argv)
+    if (args.input is None) == (args.serve is None):
+        parser.error("give either an input file or --serve")
+    if args.resume and args.output == '-':
+        parser.error("--resume needs an --output file")
+    if args.rate is not None and args.rate < 0:
+        parser.error("--rate can't be negative")
+
+    transport = Transport(pool_size=args.workers, 
+                          limiter=RateLimiter(args.rate) if args.rate 
+                                  else None)
+    coder = PostCoder(cache=SQLiteCache(args.cache) if args.cache else 
+                      LRUCache(max_entries=100000), transport=transport,
+                      dataset=args.dataset and LocalDataset(args.dataset))
+
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        server = make_server(host or '127.0.0.1', int(port), coder)
+        sys.stderr.write("serving on http://%s:%s\n" % 
+                         server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            transport.close()
+        return 0
+
+    fmt = args.format or ('jsonl' if args.input.endswith(
+        ('.jsonl', '.ndjson', '.json')) else 'csv')
+
+    def lookup(item):
+        row, error = item
+        if error is not None:
+            return row, None, error
+        try:
+            if args.lat_column:
+                result = coder.get_nearest(row.get(args.lat_column), 
+                                           row.get(args.lng_column))
+            else:
+                postcode = row.get(args.postcode_column)
+                result = coder.get('' if postcode is None else str(postcode))
+            return row, result, None if result is not None else 'not found'
+        except Exception as e:
+            # one bad row mustn't stop the others being written
+            return row, None, str(e) or e.__class__.__name__
+
+    def parse(line):
+        # malformed lines are written out as errors, so the output still 
+        # has a row for every input row
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            return {'line': line.rstrip('\r\n')}, 'invalid JSON: %s' % e
+        if not isinstance(row, dict):
+            row = {args.postcode_column: row}
+        return row, None
+
+    infile = _open_csv(args.input, 'r')
+    if fmt == 'jsonl':
+        rows = (parse(line) for line in infile if line.strip())
+    else:
+        reader = csv.DictReader(infile)
+        fields = list(reader.fieldnames or ())
+        columns = [args.lat_column, args.lng_column] if args.lat_column \
+                  else [args.postcode_column]
+        missing = [name for name in columns if name not in fields]
+        if fields and missing:
+            if infile is not sys.stdin:
+                infile.close()
+            parser.error("%s has no %s column" % (args.input, 
+                                                  ', '.join(missing)))
+        rows = ((row, None) for row in reader)
+    skip = _completed_rows(args.output, fmt) if args.resume else 0
+    outfile = _open_csv(args.output, 'a' if skip else 'w')
+    if fmt == 'csv':
+        fields += [name for name in CSV_FIELDS if name not in fields]
+        writer = csv.DictWriter(outfile, fields, extrasaction='ignore')
+        if not skip:
+            writer.writeheader()
+    for _ in range(skip):
+        next(rows, None)
+
+    count = errors = 0
+    start = last = _now()
+    def report(final=False):
+        elapsed = max(_now() - start, 1e-9)
+        sys.stderr.write("%s%d rows, %d errors, %.1f rows/s%s\n" % (
+            'done: ' if final else '', count, errors, count / elapsed, 
+            ', %d skipped' % skip if skip else ''))
+    try:
+        for row, result, error in _imap_bounded(lookup, rows, args.workers):
+            if fmt == 'jsonl':
+                row = dict(row, result=result, error=error)
+                outfile.write(json.dumps(row, default=_to_json) + '\n')
+            else:
+                for name, value in _flatten(result).items():
+                    row.setdefault(name, value)
+                row['error'] = error
+                writer.writerow(row)
+            count += 1
+            errors += error is not None
+            if args.progress and _now() - last >= args.progress:
+                last = _now()
+                report()
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        outfile.flush()
+        for f in (infile, outfile):
+            if f not in (sys.stdin, sys.stdout):
+                f.close()
+        transport.close()
+        if args.progress:
+            report(final=True)
+    return 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+An asyncio client for the uk-postcodes web-service, for applications
+which need to make many concurrent requests without a thread for each.
+Requests are made with the standard library's asyncio streams.
+"""
+import asyncio
+import zlib
+from urllib.parse import quote, urlsplit
+
+import postcodes
+from postcodes import _MISSING, _check_distance, _check_point, \
+                      _decode_json_resp, _distance_url, _nearest_url, \
+                      _normalise_postcode, _postcode_url, \
+                      TTLCache, is_valid_postcode
+
+
+class AsyncPostCoder(object):
+    """
+    The asyncio equivalent of `postcodes.PostCoder`. All of the lookup
+    methods are coroutines, but otherwise behave like (and share cache
+    keys with) their `PostCoder` counterparts, so the two can share a
+    cache. Concurrent requests for the same uncached data are coalesced
+    into a single request.
+
+    :param cache: optional cache to store responses in. Defaults to an
+                  unbounded ``dict``.
+
+    :param negative_cache: optional cache for lookups which found no
+                           data. Defaults to a `TTLCache` of up to 10,000
+                           results which expire after an hour, as for
+                           `postcodes.PostCoder`.
+
+    :param max_concurrency: maximum number of requests to make to the
+                            web-service at once.
+
+    :param timeout: seconds to wait for a connection and a response.
+    """
+
+    def __init__(self, cache=None, max_concurrency=10, timeout=30,
+                 negative_cache=None):
+        self.cache = {} if cache is None else cache
+        self.negative_cache = TTLCache(3600, max_entries=10000) \
+                              if negative_cache is None else negative_cache
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._semaphore = None
+        self._inflight = {}
+
+    # cached results are stored and looked up as by PostCoder, so the
+    # two can share caches
+    _cached = postcodes.PostCoder._cached
+    _store = postcodes.PostCoder._store
+
+    async def _request(self, url):
+        """ Returns the HTTP status and body of a GET request for `url`. """
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = loop, asyncio.Semaphore(self.max_concurrency)
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = ('GET %s HTTP/1.0\r\nHost: %s\r\nAccept-Encoding: gzip\r\n'
+                   'Connection: close\r\n\r\n' % (path, parts.netloc))
+        async with self._semaphore[1]:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(parts.hostname,
+                                            parts.port or (443 if https
+                                                           else 80),
+                                            ssl=https or None),
+                    self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise postcodes.ServiceException(
+                    "Request for %s failed: %r" % (url, e))
+            try:
+                writer.write(request.encode('latin-1'))
+                await writer.drain()
+                raw = await asyncio.wait_for(reader.read(), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise postcodes.ServiceException(
+                    "Request for %s failed: %r" % (url, e))
+            finally:
+                writer.close()
+        head, _, body = raw.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            raise postcodes.ServiceException(
+                "Request for %s returned a malformed response" % url)
+        headers = dict((k.strip().lower(), v.strip()) for k, _, v in
+                       (line.partition(':') for line in lines[1:]))
+        if headers.get('content-encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                raise postcodes.ServiceException(
+                    "Request for %s returned a corrupt response: %s" % 
+                    (url, e))
+        return status, body
+
+    async def _fetch(self, url, key):
+        status, body = await self._request(url)
+        result = _decode_json_resp(url, status, body)
+        self._store(key, result)
+        return result
+
+    async def _lookup(self, skip_cache, url, *key):
+        """
+        Checks for cached responses, before requesting from
+        web-service
+        """
+        if not skip_cache:
+            result = self._cached(key)
+            if result is not _MISSING:
+                return result
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # one cancelled caller mustn't cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def get(self, postcode, skip_cache=False):
+        """ The asyncio equivalent of `postcodes.PostCoder.get`. """
+        if not is_valid_postcode(postcode):
+            return None
+        postcode = _normalise_postcode(postcode)
+        return await self._lookup(skip_cache, _postcode_url(postcode),
+                                  postcode)
+
+    async def get_nearest(self, lat, lng, skip_cache=False):
+        """ The asyncio equivalent of `postcodes.PostCoder.get_nearest`. """
+        lat, lng = float(lat), float(lng)
+        _check_point(lat, lng)
+        return await self._lookup(skip_cache, _nearest_url(lat, lng),
+                                  lat, lng)
+
+    async def get_from_postcode(self, postcode, distance, skip_cache=False):
+        """
+        The asyncio equivalent of `postcodes.PostCoder.get_from_postcode`.
+        """
+        distance = float(distance)
+        _check_distance(distance)
+        if not is_valid_postcode(postcode):
+            return None
+        postcode = _normalise_postcode(postcode)
+        url = _distance_url(distance, 'postcode=%s' % quote(postcode))
+        return await self._lookup(skip_cache, url, postcode, distance)
+
+    async def get_from_geo(self, lat, lng, distance, skip_cache=False):
+        """
+        The asyncio equivalent of `postcodes.PostCoder.get_from_geo`.
+        """
+        lat, lng, distance = float(lat), float(lng), float(distance)
+        _check_distance(distance)
+        _check_point(lat, lng)
+        url = _distance_url(distance, 'lat=%s' % lat, 'lng=%s' % lng)
+        return await self._lookup(skip_cache, url, lat, lng, distance)
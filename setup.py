@@ -18,11 +18,13 @@ setup(
                 'information. You can also search for other postcodes within' \
                 'a distance of a point or other postcode.',
     long_description=__doc__,
-    py_modules=['postcodes'],
+    py_modules=['postcodes', 'postcodes_async'],
     zip_safe=False,
     include_package_data=True,
     platforms='any',
     install_requires=[],
+    extras_require={'numpy': ['numpy'], 'json': ['orjson']},
+    entry_points={'console_scripts': ['postcodes = postcodes:main']},
     tests_require=['mock'],
     test_suite='tests',
     classifiers=[
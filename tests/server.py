@@ -0,0 +1,210 @@
+"""
+A local stand-in for the uk-postcodes web-service, serving the
+``/postcode/``, ``/latlng/`` and ``/distance.php`` endpoints from a
+small in-memory dataset.
+"""
+import gzip
+import io
+import json
+import math
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+
+POSTCODES = {
+    'SW1A2TT': (51.502308, -0.124331),
+    'SW1A2AA': (51.503396, -0.127640),
+    'SW1A1AA': (51.501009, -0.141588),
+    'W1A1AA': (51.518561, -0.143799),
+    'EC1A1BB': (51.520180, -0.097732),
+}
+
+
+def make_record(postcode, lat, lng):
+    """ Builds a record in the same shape as the web-service's. """
+    postcode = '%s %s' % (postcode[:-3], postcode[-3:])
+    area = {'title': 'Westminster', 'uri': 'http://example.com/district'}
+    return {
+        'postcode': postcode,
+        'geo': {'lat': str(lat), 'lng': str(lng), 'easting': '530283',
+                'northing': '179820', 'geohash': 'http://geohash.org/gcp'},
+        'administrative': {
+            'district': dict(area, snac='00BK'),
+            'ward': dict(area, snac='00BKGQ'),
+            'constituency': dict(area, code='E14001036'),
+        },
+    }
+
+
+def write_csv(path, postcodes=None):
+    """
+    Writes `postcodes` to a CSV file in the ONS Postcode Directory
+    layout, with one postcode that has no location.
+    """
+    postcodes = POSTCODES if postcodes is None else postcodes
+    with open(path, 'w') as f:
+        f.write('pcd,pcds,lat,long,oseast1m,osnrth1m,laua,osward,pcon\n')
+        for postcode, (lat, lng) in sorted(postcodes.items()):
+            pcds = '%s %s' % (postcode[:-3], postcode[-3:])
+            f.write('%s,%s,%s,%s,530283,179820,E09000033,E05000644,'
+                    'E14001036\n' % (pcds.ljust(7), pcds, lat, lng))
+        f.write('ZZ1 1ZZ,ZZ1 1ZZ,99.999999,0.000000,,,,,\n')
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """ Great circle distance in miles between two points. """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) *
+         math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 3958.8 * math.asin(math.sqrt(a))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            failure = self.server.failures.pop(0) \
+                      if self.server.failures else None
+        url = urlsplit(self.path)
+        if url.path.startswith('/moved/'):
+            self.send_response(301)
+            self.send_header('Location', self.path.replace('/moved', '', 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if failure == 'drop':
+            self.close_connection = True
+            return
+        if failure == 'corrupt':
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', '8')
+            self.end_headers()
+            self.wfile.write(b'not gzip')
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if failure is not None:
+            return self.respond(failure, b'error')
+        if url.path.startswith('/postcode/'):
+            postcode = url.path[len('/postcode/'):-len('.json')].upper()
+            data = self.server.lookup(postcode)
+        elif url.path.startswith('/latlng/'):
+            lat, lng = url.path[len('/latlng/'):-len('.json')].split(',')
+            data = self.server.nearest(float(lat), float(lng))
+        elif url.path == '/distance.php':
+            query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            data = self.server.within(query)
+        else:
+            data = None
+        if data is None:
+            return self.respond(404, b'')
+        self.respond(200, json.dumps(data).encode('utf-8'))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server on a free local port. `connections` and
+    `requests` record the connections opened and paths requested.
+    Appending HTTP statuses, ``'drop'`` to drop the connection, or
+    ``'corrupt'`` to send an invalid gzip body, to `failures` makes the
+    next requests fail. Paths starting ``/moved/`` are redirected to the
+    rest of the path, and absolute URLs are answered like a proxy.
+
+    Each response is delayed by `latency` seconds, and each record is
+    padded with `padding` bytes, to imitate a slower service and larger
+    payloads.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, postcodes=None, latency=0, padding=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.postcodes = POSTCODES if postcodes is None else postcodes
+        self.latency = latency
+        self.padding = padding
+        self.connections = 0
+        self.requests = []
+        self.failures = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, postcode, point):
+        record = make_record(postcode, *point)
+        if self.padding:
+            record['padding'] = 'x' * self.padding
+        return record
+
+    def lookup(self, postcode):
+        if postcode not in self.postcodes:
+            return None
+        return self.record(postcode, self.postcodes[postcode])
+
+    def nearest(self, lat, lng):
+        if not self.postcodes:
+            return None
+        postcode = min(self.postcodes, key=lambda p:
+                       distance(lat, lng, *self.postcodes[p]))
+        return self.lookup(postcode)
+
+    def within(self, query):
+        if 'postcode' in query:
+            centre = self.postcodes.get(query['postcode'].upper())
+            if centre is None:
+                return None
+        else:
+            centre = float(query['lat']), float(query['lng'])
+        results = []
+        for postcode, point in sorted(self.postcodes.items()):
+            dist = distance(centre[0], centre[1], *point)
+            if dist <= float(query['distance']):
+                record = self.record(postcode, point)
+                record['distance'] = '%.6f' % dist
+                results.append(record)
+        return sorted(results, key=lambda r: float(r['distance']))
@@ -1,10 +1,26 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 
 from mock import patch, call
 
 import postcodes
 from postcodes import PostCoder, IllegalPointException, \
-                      IllegalDistanceException
+                      IllegalDistanceException, LRUCache, TTLCache, \
+                      SQLiteCache, Transport, ServiceException, \
+                      LocalDataset, SpatialIndex, PostcodeRecord, \
+                      RetryPolicy, CircuitBreaker, CircuitOpenException, \
+                      RateLimiter, AdaptiveLimiter, Metrics
+
+from .server import StubServer, distance, make_record, write_csv
 
 class TestPostCodes(unittest.TestCase):
 
@@ -16,14 +32,14 @@ class TestPostCodes(unittest.TestCase):
         """ Tests postcodes.get """
         postcodes.get("foo")
         exp = "http://www.uk-postcodes.com/postcode/foo.json"
-        mock.assert_called_once_with(exp)
+        mock.assert_called_once_with(exp, transport=None)
 
     @patch('postcodes._get_json_resp')
     def test_get_nearest(self, mock):
         """ Tests postcodes.get_nearest """
         postcodes.get_nearest(1.1, -2.2)
         exp = "http://www.uk-postcodes.com/latlng/1.1,-2.2.json"
-        mock.assert_called_once_with(exp)
+        mock.assert_called_once_with(exp, transport=None)
 
     @patch('postcodes._get_json_resp')
     def test__get_from(self, mock):
@@ -31,7 +47,7 @@ class TestPostCodes(unittest.TestCase):
         postcodes._get_from(1, 'foo=bar', 'zoo=boo')
         exp = "http://www.uk-postcodes.com/distance.php?"\
               "foo=bar&zoo=boo&distance=1&format=json"
-        mock.assert_called_once_with(exp)
+        mock.assert_called_once_with(exp, transport=None)
 
     @patch('postcodes._get_json_resp')
     def test_get_from_postcode(self, mock):
@@ -39,7 +55,7 @@ class TestPostCodes(unittest.TestCase):
         postcodes.get_from_postcode('W1 1', 1)
         exp = "http://www.uk-postcodes.com/distance.php?"\
               "postcode=W11&distance=1&format=json"
-        mock.assert_called_once_with(exp)
+        mock.assert_called_once_with(exp, transport=None)
 
     @patch('postcodes._get_json_resp')
     def test_get_from_geo(self, mock):
@@ -47,7 +63,7 @@ class TestPostCodes(unittest.TestCase):
         postcodes.get_from_geo(1, 2, 1)
         exp = "http://www.uk-postcodes.com/distance.php?"\
               "lat=1&lng=2&distance=1&format=json"
-        mock.assert_called_once_with(exp)
+        mock.assert_called_once_with(exp, transport=None)
 
 
 class TestPostCoder(unittest.TestCase):
@@ -111,7 +127,1243 @@ class TestPostCoder(unittest.TestCase):
         self.assertRaises(IllegalPointException, f, 91, 0, 0)
         self.assertRaises(IllegalDistanceException, f, -30, 20, -11)
 
+    @patch('postcodes._now')
+    @patch('postcodes.get')
+    def test_negative_cache(self, mock, now):
+        """ Tests PostCoder caches missing data separately """
+        now.return_value = 0
+        mock.return_value = None
+        pc = PostCoder(negative_cache=TTLCache(10, max_entries=2))
+        self.assertIsNone(pc.get('ZZ1 1ZZ'))
+        self.assertIsNone(pc.get('zz11zz'))
+        self.assertEqual(mock.call_count, 1)
+        self.assertNotIn(('zz11zz',), pc.cache)
+        self.assertEqual(pc.negative_cache.stats()['hits'], 1)
+        now.return_value = 10
+        pc.get('ZZ1 1ZZ')
+        self.assertEqual(mock.call_count, 2)
+
+        mock.return_value = {'postcode': 'ZZ1 1ZZ'}
+        pc.get('ZZ1 1ZZ', skip_cache=True)
+        self.assertNotIn(('zz11zz',), pc.negative_cache)
+        mock.return_value = None
+        pc.get('ZZ1 1ZZ', skip_cache=True)
+        self.assertNotIn(('zz11zz',), pc.cache)
+        self.assertIsNone(pc.get('ZZ1 1ZZ'))
+        self.assertEqual(mock.call_count, 4)
+
+    @patch('postcodes.get_from_postcode')
+    @patch('postcodes.get')
+    def test_invalid_postcodes(self, get, get_from_postcode):
+        """ Tests PostCoder rejects invalid postcodes without a request """
+        for postcode in ('foo', 'W1A', '1AA 1AA', 'W1A 1A1', ''):
+            self.assertFalse(postcodes.is_valid_postcode(postcode))
+            self.assertIsNone(self.pc.get(postcode))
+            self.assertIsNone(self.pc.get_from_postcode(postcode, 1))
+            self.assertEqual(list(self.pc.get_from_postcode(
+                postcode, 1, stream=True)), [])
+        for postcode in ('W1A 1AA', 'ec1a1bb', 'M1 1AE', 'B33 8TH', 
+                         'CR2 6XH', 'DN55 1PT', 'GIR 0AA'):
+            self.assertTrue(postcodes.is_valid_postcode(postcode))
+        self.assertFalse(get.called)
+        self.assertFalse(get_from_postcode.called)
+
+    @patch('postcodes.get')
+    def test_single_flight(self, mock):
+        """ Tests PostCoder coalesces concurrent requests """
+        release = threading.Event()
+        def slow_get(postcode):
+            release.wait(5)
+            if postcode == 'zz11zz':
+                raise ServiceException('down')
+            return {'postcode': postcode}
+        mock.side_effect = slow_get
+        results, errors = [], []
+        def lookup(postcode):
+            try:
+                results.append(self.pc.get(postcode))
+            except ServiceException as e:
+                errors.append(e)
+        threads = [threading.Thread(target=lookup, args=(p,)) 
+                   for p in ['F0 0BA'] * 10 + ['ZZ1 1ZZ'] * 5]
+        for thread in threads:
+            thread.start()
+        while len(self.pc._inflight) < 2:
+            time.sleep(0.01)
+        time.sleep(0.1) # let the other threads start waiting
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(results, [{'postcode': 'f00ba'}] * 10)
+        self.assertEqual(len(errors), 5)
+        self.assertNotIn(('zz11zz',), self.pc.cache)
+        self.assertEqual(self.pc._inflight, {})
+
+    @patch('postcodes.get_from_postcode')
+    def test_prefetch_workers(self, mock):
+        """ Tests PostCoder runs at most PREFETCH_WORKERS prefetches """
+        release = threading.Event()
+        mock.side_effect = lambda *args, **kwargs: release.wait(5) and []
+        self.pc = PostCoder(prefetch_distance=1)
+        self.pc._sectors['ec1a1'] = None
+        threads = [self.pc._prefetch(p) for p in 
+                   ('sw1a2tt', 'w1a1aa', 'ec1a1bb', 'n11aa')]
+        self.assertEqual([t is None for t in threads], 
+                         [False, False, True, True])
+        self.assertEqual(self.pc._sectors['ec1a1'], 0) # may be retried
+        release.set()
+        for thread in threads[:2]:
+            thread.join()
+        self.assertIsNotNone(self.pc._prefetch('n11aa'))
+        self.assertEqual(mock.call_count, 3)
+
+    @patch('postcodes.get')
+    def test_slow_cache(self, mock):
+        """ Tests a slow cache doesn't hold up other PostCoder lookups """
+        release, reading = threading.Event(), threading.Event()
+        class SlowCache(dict):
+            def get(self, key, default=None):
+                if key == ('f00ba',):
+                    reading.set()
+                    release.wait(5)
+                return dict.get(self, key, default)
+        self.pc = PostCoder(cache=SlowCache({('w1a1aa',): {'postcode': 1}}))
+        mock.return_value = {'postcode': 2}
+        thread = threading.Thread(target=self.pc.get, args=('F0 0BA',))
+        thread.start()
+        try:
+            reading.wait(5)
+            start = time.time()
+            self.assertEqual(self.pc.get('W1A 1AA'), {'postcode': 1})
+            self.assertEqual(self.pc.get('SW1A 2TT'), {'postcode': 2})
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(self.pc._inflight, {})
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        """ Tests LRUCache evicts by entry count """
+        cache = LRUCache(max_entries=2)
+        cache['a'], cache['b'] = 1, 2
+        cache.get('a') # 'b' is now least recently used
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache['c'], 3)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (3, 1, 1))
+
+    def test_max_bytes(self):
+        """ Tests LRUCache evicts by size """
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache['a'] = 'xxxxxx'
+        cache['b'] = 'yyyyyy'
+        self.assertEqual(list(cache._data), ['b'])
+        self.assertEqual(cache.bytes, 6)
+        del cache['b']
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_caches_none(self):
+        """ Tests LRUCache distinguishes cached None from a miss """
+        cache = LRUCache()
+        cache['a'] = None
+        self.assertIsNone(cache.get('a', 'missing'))
+
+    @patch('postcodes._now')
+    def test_ttl(self, now):
+        """ Tests TTLCache expires entries """
+        now.return_value = 100
+        cache = TTLCache(10, max_entries=5)
+        cache['a'] = 1
+        now.return_value = 109
+        self.assertEqual(cache.get('a'), 1)
+        now.return_value = 110
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    @patch('postcodes.get')
+    def test_postcoder_cache(self, mock):
+        """ Tests PostCoder uses a provided cache """
+        pc = PostCoder(cache=LRUCache(max_entries=1))
+        pc.get("F0 0BA")
+        pc.get("F0 0BB")
+        pc.get("F0 0BA")
+        self.assertEqual(mock.call_count, 3)
+        self.assertEqual(pc.cache.stats()['evictions'], 2)
+
+
+class TestSQLiteCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_persists(self):
+        """ Tests SQLiteCache stores responses across instances """
+        cache = SQLiteCache(self.path)
+        cache[('w1a1aa',)] = {'postcode': 'W1A 1AA'}
+        cache[('zz99zz',)] = None
+        other = SQLiteCache(self.path)
+        self.assertEqual(other.get(('w1a1aa',)), {'postcode': 'W1A 1AA'})
+        self.assertIsNone(other.get(('zz99zz',), 'missing'))
+        self.assertEqual(other.get(('foo',), 'missing'), 'missing')
+        self.assertIn(('w1a1aa',), other)
+        self.assertEqual(len(other), 2)
+        self.assertEqual(other.stats()['misses'], 1)
+
+    def test_max_entries(self):
+        """ Tests SQLiteCache removes the oldest entries """
+        cache = SQLiteCache(self.path, max_entries=2)
+        for i in range(5):
+            cache[(i, 1.5)] = i
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache[(4, 1.5)], 4)
+        self.assertNotIn((2, 1.5), cache)
+        # rewriting a key keeps the others
+        cache = SQLiteCache(self.path, max_entries=3)
+        cache.clear()
+        for key in 'abcaaa':
+            cache[(key,)] = key
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([k for k, _ in cache.items()], 
+                         [('b',), ('c',), ('a',)])
+        cache[('d',)] = 'd'
+        self.assertEqual([k for k, _ in cache.items()], 
+                         [('c',), ('a',), ('d',)])
+
+    def test_snapshot(self):
+        """ Tests PostCoder.dump and PostCoder.load """
+        pc = PostCoder(cache=SQLiteCache(self.path))
+        record = make_record('SW1A2TT', 51.502308, -0.124331)
+        pc.cache[('sw1a2tt',)] = record
+        pc.cache[('sw1a2tt', 1.0)] = [dict(record, distance='0.000000')]
+        pc.cache[('~radius', 'sw1a2tt')] = 1.0
+        path = os.path.join(self.dir, 'snapshot.jsonl')
+        with open(path, 'w') as f:
+            self.assertEqual(pc.dump(f), 3)
+        other = PostCoder(cache=LRUCache(), compact=True)
+        with open(path) as f:
+            self.assertEqual(other.load(f), 3)
+        self.assertEqual(sorted(other.cache.items(), key=repr),
+                         sorted(pc.cache.items(), key=repr))
+        self.assertIsInstance(other.get('SW1A 2TT'), PostcodeRecord)
+        # snapshots of compact records are the same as of dicts
+        with open(path, 'w') as f:
+            other.dump(f)
+        with open(path) as f:
+            self.assertEqual(PostCoder().load(f), 3)
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.transport = Transport(pool_size=2)
+        self.patcher = patch('postcodes.END_POINT', self.server.url)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.transport.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        """ Tests Transport reuses connections """
+        for _ in range(3):
+            result = postcodes.get('SW1A 2TT', transport=self.transport)
+            self.assertEqual(result['postcode'], 'SW1A 2TT')
+        self.assertIsNone(postcodes.get('ZZ1 1ZZ', transport=self.transport))
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_stale_connection(self):
+        """ Tests Transport reconnects if an idle connection was closed """
+        transport = Transport(retry=RetryPolicy(0))
+        postcodes.get('SW1A 2TT', transport=transport)
+        self.server.failures.append('drop')
+        result = postcodes.get('SW1A 2TT', transport=transport)
+        self.assertEqual(result['postcode'], 'SW1A 2TT')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(transport.stats()['attempts'], 2)
+        transport.close()
+
+    def test_redirects(self):
+        """ Tests Transport follows redirects """
+        url = self.server.url + '/moved/postcode/W1A1AA.json'
+        status, body = self.transport.request(url)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8'))['postcode'], 
+                         'W1A 1AA')
+        self.assertEqual(self.server.requests, ['/moved/postcode/W1A1AA.json', 
+                                                '/postcode/W1A1AA.json'])
+        self.assertEqual(self.server.connections, 1)
+        url = self.server.url + '/moved' * 6 + '/postcode/W1A1AA.json'
+        self.assertRaises(ServiceException, self.transport.request, url)
+
+    def test_proxies(self):
+        """ Tests Transport connects through proxies """
+        url = 'http://postcodes.invalid/postcode/W1A1AA.json'
+        transport = Transport(proxies={'http': self.server.url})
+        self.assertEqual(transport.request(url)[0], 200)
+        self.assertEqual(self.server.requests, [url])
+        transport.close()
+        with patch.dict(os.environ, {'http_proxy': self.server.url, 
+                                     'no_proxy': 'example.com'}):
+            transport = Transport()
+            self.assertEqual(transport.request(url)[0], 200)
+            self.assertIsNone(transport._proxy('http', 'example.com'))
+            self.assertIsNone(Transport(proxies={})._proxy('http', 'a.com'))
+            transport.close()
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(Transport(proxies={'https': 'u:p@proxy:3128'})
+                         ._proxy('https', 'a.com'), 
+                         ('proxy:3128', {'Proxy-Authorization': 
+                                         'Basic dTpw'}))
+
+    def test_slow_reused_connection(self):
+        """ Tests Transport doesn't resend requests which timed out """
+        transport = Transport(read_timeout=0.5, 
+                              retry=RetryPolicy(0, deadline=0.7))
+        transport.request(self.server.url + '/postcode/W1A1AA.json')
+        self.server.latency = 1
+        start = time.time()
+        self.assertRaises(ServiceException, transport.request, 
+                          self.server.url + '/postcode/W1A1AA.json')
+        self.assertLess(time.time() - start, 0.7)
+        self.assertEqual(len(self.server.requests), 2)
+        transport.close()
+
+    def test_gzip(self):
+        """ Tests Transport decompresses responses """
+        status, body = self.transport.request(self.server.url + 
+                                              '/postcode/W1A1AA.json')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8'))['postcode'], 
+                         'W1A 1AA')
+
+    def test_unavailable(self):
+        """ Tests Transport raises ServiceException """
+        self.server.stop()
+        transport = Transport(connect_timeout=1)
+        self.assertRaises(ServiceException, transport.request, 
+                          self.server.url + '/postcode/W1A1AA.json')
+        self.server = StubServer().start()
+
+    def test_postcoder(self):
+        """ Tests PostCoder uses its transport """
+        pc = PostCoder(transport=self.transport)
+        self.assertEqual(len(pc.get_from_geo(51.5, -0.13, 2)), 5)
+        self.assertEqual(pc.get_nearest(51.5185, -0.1437)['postcode'], 
+                         'W1A 1AA')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_radius_reuse(self):
+        """ Tests smaller radius searches reuse larger cached ones """
+        pc = PostCoder(transport=self.transport, geo_precision=3)
+        self.assertEqual(len(pc.get_from_geo(51.5001, -0.1301, 2)), 5)
+        expected = postcodes.get_from_geo(51.5, -0.13, 1, 
+                                          transport=self.transport)
+        requests = len(self.server.requests)
+        self.assertEqual(pc.get_from_geo(51.49999, -0.13, 1), expected)
+        self.assertEqual(pc.get_from_geo(51.5, -0.13, 0), [])
+        self.assertEqual(len(self.server.requests), requests)
+        pc.get_from_geo(51.5, -0.13, 3)
+        self.assertEqual(len(self.server.requests), requests + 1)
+
+        results = pc.get_from_postcode('SW1A 2TT', 1)
+        self.assertEqual(pc.get_from_postcode('sw1a2tt', 0.2), 
+                         [r for r in results if float(r['distance']) <= 0.2])
+        self.assertIsNone(pc.get_from_postcode('ZZ1 1ZZ', 1))
+        self.assertIsNone(pc.get_from_postcode('ZZ1 1ZZ', 0.5))
+        self.assertEqual(len(self.server.requests), requests + 3)
+
+    def test_filter_radius(self):
+        """ Tests _filter_radius """
+        near = {'geo': {'lat': '51.5', 'lng': '-0.1'}}
+        far = {'lat': '52.5', 'lng': '-0.1'}
+        self.assertEqual(postcodes._filter_radius([near, far], 10, 
+                                                  (51.5, -0.1)), [near])
+        self.assertIs(postcodes._filter_radius([near], 10), 
+                      postcodes._MISSING)
+        self.assertIs(postcodes._filter_radius([{'distance': 'x'}], 10), 
+                      postcodes._MISSING)
+
+    def test_stream(self):
+        """ Tests streaming radius searches """
+        expected = postcodes.get_from_geo(51.5, -0.13, 2, 
+                                          transport=self.transport)
+        for gzip in (True, False):
+            transport = Transport(gzip=gzip)
+            results = postcodes.get_from_geo(51.5, -0.13, 2, stream=True,
+                                             transport=transport)
+            self.assertFalse(isinstance(results, list))
+            self.assertEqual(list(results), expected)
+            transport.close()
+        pc = PostCoder(transport=self.transport)
+        results = pc.get_from_postcode('SW1A 2TT', 0.2, stream=True)
+        self.assertEqual([r['postcode'] for r in results], 
+                         ['SW1A 2TT', 'SW1A 2AA'])
+        self.assertEqual(list(pc.get_from_postcode('ZZ1 1ZZ', 1, 
+                                                   stream=True)), [])
+        self.assertEqual(list(pc.get_from_geo(51.5, -0.13, 2, 
+                                              stream=True)), expected)
+        self.assertEqual(pc.cache, {})
+        # abandoned streams don't leave connections in the pool
+        results = pc.get_from_geo(51.5, -0.13, 2, stream=True)
+        next(results)
+        results.close()
+        self.assertEqual(len(pc.get_from_geo(51.5, -0.13, 2)), 5)
+
+    def test_iter_json_array(self):
+        """ Tests _iter_json_array with small chunks """
+        data = [{'postcode': u'W1A 1AA \u00a3', 'n': [1, 2.5]}, 
+                {'a': None}, 12, True, [], u'x']
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 7, len(body)):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(list(postcodes._iter_json_array(chunks)), data)
+        self.assertEqual(list(postcodes._iter_json_array([b' [ ] '])), [])
+        for body in (b'{}', b'[1 2]', b'[{"a": 1}', b''):
+            self.assertRaises(ServiceException, list, 
+                              postcodes._iter_json_array([body]))
+
+    def test_get_many(self):
+        """ Tests PostCoder.get_many """
+        pc = PostCoder(transport=self.transport)
+        pc.get('W1A 1AA')
+        inputs = ['SW1A 2TT', 'sw1a2tt', 'W1A 1AA', 'ZZ1 1ZZ', 'EC1A 1BB']
+        results = list(pc.get_many(inputs, max_workers=2))
+        self.assertEqual([r.postcode for r in results], 
+                         ['sw1a2tt', 'w1a1aa', 'zz11zz', 'ec1a1bb'])
+        self.assertEqual([r.result and r.result['postcode'] for r in results],
+                         ['SW1A 2TT', 'W1A 1AA', None, 'EC1A 1BB'])
+        self.assertEqual(len(self.server.requests), 4)
+        results = pc.get_many(['SW1A 2AA', 'SW1A 1AA'], ordered=False)
+        self.assertEqual(sorted(r.postcode for r in results), 
+                         ['sw1a1aa', 'sw1a2aa'])
+
+    @patch('postcodes.get')
+    def test_get_many_errors(self, mock):
+        """ Tests PostCoder.get_many reports errors per postcode """
+        mock.side_effect = lambda p: ({'postcode': p} if p != 'b11aa' 
+                                      else 1 / 0)
+        results = list(PostCoder().get_many(('A1 1AA', 'B1 1AA', 'C1 1AA') 
+                                            * 50, ordered=False))
+        self.assertEqual(len(results), 3)
+        errors = dict((r.postcode, r.error) for r in results)
+        self.assertIsInstance(errors['b11aa'], ZeroDivisionError)
+        self.assertIsNone(errors['a11aa'])
+
+    def test_prefetch(self):
+        """ Tests PostCoder prefetches hot sectors """
+        pc = PostCoder(transport=self.transport, prefetch_distance=1)
+        pc.get('SW1A 2TT')
+        pc.get('W1A 1AA')
+        self.assertEqual(len(self.server.requests), 2)
+        pc.get('SW1A 2AA') # the second uncached lookup in SW1A 2
+        for _ in range(100):
+            if ('sw1a1aa',) in pc.cache:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertTrue(self.server.requests[-1].startswith('/distance.php'))
+        result = pc.get('SW1A 1AA')
+        self.assertEqual(result, make_record('SW1A1AA', 51.501009, -0.141588))
+        self.assertNotIn(('ec1a1bb',), pc.cache) # out of range
+        # the sector is only prefetched once
+        pc.get('SW1A 2TT', skip_cache=True)
+        pc.cache.clear()
+        pc.get('SW1A 2AA')
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertFalse(self.server.requests[-1].startswith('/distance.php'))
+
+    def test_nearest_cells(self):
+        """ Tests PostCoder.get_nearest reuses results within a cell """
+        pc = PostCoder(transport=self.transport, nearest_precision=6)
+        self.assertEqual(pc.get_nearest(51.50231, -0.12433)['postcode'],
+                         'SW1A 2TT')
+        # GPS jitter of a metre or so is answered from the cache
+        self.assertEqual(pc.get_nearest(51.50232, -0.12434)['postcode'],
+                         'SW1A 2TT')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn(('sw1a2tt',), pc.cache)
+        # in the same cell, but SW1A 2TT may not be the nearest
+        self.assertEqual(pc.get_nearest(51.50285, -0.12599)['postcode'],
+                         'SW1A 2AA')
+        self.assertEqual(len(self.server.requests), 2)
+        pc = PostCoder(transport=self.transport, nearest_precision=6, 
+                       nearest_tolerance=1)
+        pc.get_nearest(51.50231, -0.12433)
+        self.assertEqual(pc.get_nearest(51.50285, -0.12599)['postcode'],
+                         'SW1A 2TT')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_warm(self):
+        """ Tests PostCoder.warm prefetches in the background """
+        self.server.latency = 0.1
+        pc = PostCoder(transport=self.transport)
+        thread = pc.warm(['SW1A 2TT', 'W1A 1AA', 'ZZ1 1ZZ'], max_workers=2)
+        # a lookup made during the warm-up waits for the prefetch
+        self.assertEqual(pc.get('W1A 1AA')['postcode'], 'W1A 1AA')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIn(('sw1a2tt',), pc.cache)
+        self.assertIn(('zz11zz',), pc.negative_cache)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class TestLocalDataset(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        csv_path = os.path.join(self.dir, 'onspd.csv')
+        write_csv(csv_path)
+        self.dataset = LocalDataset.build(csv_path, 
+                                          os.path.join(self.dir, 'index'))
+
+    def tearDown(self):
+        self.dataset.close()
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        """ Tests LocalDataset.get """
+        self.assertEqual(len(self.dataset), 5)
+        result = self.dataset.get('sw1a 2tt')
+        self.assertEqual(result['postcode'], 'SW1A 2TT')
+        self.assertEqual(result['geo']['lat'], '51.502308')
+        self.assertEqual(result['geo']['lng'], '-0.124331')
+        self.assertEqual(result['geo']['northing'], '179820')
+        self.assertEqual(result['geo']['geohash'], 
+                         'http://geohash.org/gcpuvptqwyh4')
+        admin = result['administrative']
+        self.assertEqual(admin['district']['snac'], 'E09000033')
+        self.assertEqual(admin['constituency']['code'], 'E14001036')
+        for postcode in ('ZZ1 1ZZ', 'A', 'AAAAAAAAAAA', 'ÄB1 1AA'):
+            self.assertIsNone(self.dataset.get(postcode))
+        for postcode in ('EC1A 1BB', 'W1A1AA', 'SW1A1AA'):
+            self.assertEqual(self.dataset.get(postcode)['postcode'].replace(
+                ' ', ''), postcode.replace(' ', ''))
+
+    def test_reload(self):
+        """ Tests LocalDataset loads an existing index """
+        dataset = LocalDataset(self.dataset.path)
+        self.assertEqual(dataset.get('W1A 1AA'), self.dataset.get('W1A 1AA'))
+        dataset.close()
+        self.assertRaises(ValueError, LocalDataset, 
+                          os.path.join(self.dir, 'onspd.csv'))
+
+    @patch('postcodes._get_json_resp')
+    def test_get_functions(self, mock):
+        """ Tests postcodes.get and PostCoder.get use a dataset """
+        self.assertEqual(postcodes.get('W1A 1AA', dataset=self.dataset), 
+                         self.dataset.get('W1A 1AA'))
+        pc = PostCoder(dataset=self.dataset)
+        self.assertEqual(pc.get('w1a 1aa'), self.dataset.get('W1A 1AA'))
+        results = list(pc.get_many(['W1A 1AA', 'ZZ1 1ZZ']))
+        self.assertEqual(results[1], ('zz11zz', None, None))
+        self.assertFalse(mock.called)
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        csv_path = os.path.join(self.dir, 'onspd.csv')
+        rand = random.Random(1)
+        self.points = dict(('A%02d1AA' % i, 
+                            (rand.uniform(50, 52), rand.uniform(-2, 0)))
+                           for i in range(100))
+        write_csv(csv_path, self.points)
+        self.dataset = LocalDataset.build(csv_path, 
+                                          os.path.join(self.dir, 'index'))
+
+    def tearDown(self):
+        self.dataset.close()
+        shutil.rmtree(self.dir)
+
+    def brute_force(self, lat, lng, k):
+        dists = sorted((distance(lat, lng, *p), pc) 
+                       for pc, p in self.points.items())
+        return [pc for _, pc in dists[:k]]
+
+    def test_nearest(self):
+        """ Tests SpatialIndex.nearest against a brute force search """
+        index = SpatialIndex(self.dataset, cell_size=0.05)
+        rand = random.Random(2)
+        for _ in range(50):
+            lat, lng = rand.uniform(49, 53), rand.uniform(-3, 1)
+            results = index.nearest(lat, lng, k=3)
+            self.assertEqual([r['postcode'].replace(' ', '') 
+                              for r, _ in results],
+                             self.brute_force(lat, lng, 3))
+            self.assertAlmostEqual(results[0][1], 
+                                   distance(lat, lng, *self.points[
+                                       self.brute_force(lat, lng, 1)[0]]))
+        # far outside the data
+        result = index.nearest(-60, 170)[0][0]['postcode'].replace(' ', '')
+        self.assertEqual(result, self.brute_force(-60, 170, 1)[0])
+        self.assertEqual(len(index.nearest(51, -1, k=1000)), 100)
+        self.assertRaises(IllegalPointException, index.nearest, 91, 0)
+
+    def test_nearest_far_away(self):
+        """ Tests SpatialIndex searches quickly from far outside the data """
+        index = SpatialIndex(self.dataset)
+        start = time.time()
+        for lat, lng in ((0, 0), (-80, 170), (89, -179), (52, 179)):
+            results = index.nearest(lat, lng, k=2)
+            self.assertEqual([r['postcode'].replace(' ', '') 
+                              for r, _ in results],
+                             self.brute_force(lat, lng, 2))
+        if postcodes._numpy() is not None:
+            names, _ = index.nearest_arrays([0.0, 51.0, -80.0], 
+                                            [0.0, -1.0, 170.0])
+            self.assertEqual([n.replace(' ', '') for n in names.tolist()],
+                             [self.brute_force(0, 0, 1)[0], 
+                              self.brute_force(51, -1, 1)[0],
+                              self.brute_force(-80, 170, 1)[0]])
+        self.assertLess(time.time() - start, 1)
+
+    def test_k_nearest(self):
+        """ Tests SpatialIndex.k_nearest """
+        results = self.dataset.spatial.k_nearest([51, 50.5], [-1, -0.5], k=2)
+        self.assertEqual([[r['postcode'].replace(' ', '') for r, _ in rs] 
+                          for rs in results],
+                         [self.brute_force(51, -1, 2), 
+                          self.brute_force(50.5, -0.5, 2)])
+
+    def test_nearest_arrays(self):
+        """ Tests SpatialIndex.nearest_arrays against a brute force search """
+        if postcodes._numpy() is None:
+            self.skipTest("NumPy isn't installed")
+        import numpy as np
+        index = SpatialIndex(self.dataset, cell_size=0.2)
+        rand = random.Random(4)
+        lats = [rand.uniform(49, 53) for _ in range(300)] + [51.0] * 5
+        lngs = [rand.uniform(-3, 1) for _ in range(300)] + [-1.0] * 5
+        names, dists = index.nearest_arrays(np.array(lats), np.array(lngs))
+        self.assertEqual([n.replace(' ', '') for n in names.tolist()],
+                         [self.brute_force(lat, lng, 1)[0] 
+                          for lat, lng in zip(lats, lngs)])
+        for name, dist, lat, lng in zip(names, dists, lats, lngs):
+            point = self.points[name.replace(' ', '')]
+            self.assertAlmostEqual(dist, distance(lat, lng, *point))
+        self.assertRaises(IllegalPointException, index.nearest_arrays, 
+                          [0, 91], [0, 0])
+        self.assertRaises(IllegalPointException, index.nearest_arrays, 
+                          [float('nan')], [0])
+        self.assertRaises(ValueError, index.nearest_arrays, [0, 1], [0])
+        pc = PostCoder(dataset=self.dataset)
+        names, _ = pc.get_nearest_many([51.0], [-1.0])
+        self.assertEqual(names[0].replace(' ', ''), 
+                         self.brute_force(51, -1, 1)[0])
+        self.assertRaises(ValueError, PostCoder().get_nearest_many, [0], [0])
+
+    def check_within(self):
+        index = SpatialIndex(self.dataset, cell_size=0.1)
+        rand = random.Random(3)
+        for _ in range(20):
+            lat, lng = rand.uniform(49.5, 52.5), rand.uniform(-2.5, 0.5)
+            dist = rand.uniform(0, 40)
+            expected = [pc for pc in self.brute_force(lat, lng, 100)
+                        if distance(lat, lng, *self.points[pc]) <= dist]
+            results = index.within(lat, lng, dist)
+            self.assertEqual([r['postcode'].replace(' ', '') 
+                              for r, _ in results], expected)
+            self.assertEqual(len(index.within(lat, lng, dist, limit=2)), 
+                             min(2, len(expected)))
+        self.assertEqual(len(index.within(51, -1, 10000)), 100)
+        self.assertRaises(IllegalDistanceException, index.within, 0, 0, -1)
+
+    def test_within(self):
+        """ Tests SpatialIndex.within against a brute force search """
+        self.check_within()
+
+    @patch('postcodes._numpy', return_value=None)
+    def test_within_without_numpy(self, mock):
+        """ Tests SpatialIndex.within without NumPy """
+        self.check_within()
+
+    @patch('postcodes._get_json_resp')
+    def test_get_from(self, mock):
+        """ Tests radius searches use a dataset """
+        postcode = self.brute_force(51, -1, 1)[0]
+        expected = [pc for pc in self.brute_force(51, -1, 100)
+                    if distance(51, -1, *self.points[pc]) <= 20]
+        results = postcodes.get_from_geo(51, -1, 20, dataset=self.dataset)
+        self.assertEqual([r['postcode'].replace(' ', '') for r in results],
+                         expected)
+        self.assertAlmostEqual(float(results[0]['distance']), 
+                               distance(51, -1, *self.points[postcode]), 5)
+        pc = PostCoder(dataset=self.dataset)
+        self.assertEqual(pc.get_from_geo('51', -1, 20), results)
+        results = pc.get_from_postcode(postcode, 5)
+        self.assertEqual(results[0]['postcode'].replace(' ', ''), postcode)
+        self.assertEqual(results[0]['distance'], '0.000000')
+        self.assertEqual(results, postcodes.get_from_postcode(
+            postcode, 5, dataset=self.dataset))
+        self.assertIsNone(pc.get_from_postcode('ZZ1 1ZZ', 5))
+        self.assertFalse(mock.called)
+
+    @patch('postcodes._get_json_resp')
+    def test_get_nearest(self, mock):
+        """ Tests get_nearest and PostCoder.get_nearest use a dataset """
+        expected = self.brute_force(51.2, -1.1, 1)[0]
+        result = postcodes.get_nearest(51.2, -1.1, dataset=self.dataset)
+        self.assertEqual(result['postcode'].replace(' ', ''), expected)
+        pc = PostCoder(dataset=self.dataset)
+        self.assertEqual(pc.get_nearest('51.2', '-1.1'), result)
+        self.assertFalse(mock.called)
+
+
+class TestPostcodeRecord(unittest.TestCase):
+    def test_from_dict(self):
+        """ Tests PostcodeRecord round trips postcode data """
+        data = make_record('SW1A2TT', 51.502308, -0.124331)
+        record = PostcodeRecord.from_dict(data)
+        self.assertIsInstance(record, PostcodeRecord)
+        self.assertEqual(record, data)
+        self.assertEqual(record.to_dict(), data)
+        self.assertEqual(record['geo']['lat'], '51.502308')
+        self.assertEqual(record.get('distance'), None)
+        self.assertNotIn('distance', record)
+        other = PostcodeRecord.from_dict(make_record('SW1A2AA', 51.5, -0.1))
+        self.assertIs(record.areas, other.areas)
+        self.assertFalse(hasattr(record, '__dict__'))
+        # the table of shared areas is bounded
+        with patch.dict('postcodes._AREAS', clear=True), \
+                patch('postcodes._AREAS_LIMIT', 10):
+            for i in range(20):
+                other = make_record('SW1A2AA', 51.5, -0.1)
+                other['administrative']['ward']['title'] = 'Ward %d' % i
+                self.assertEqual(PostcodeRecord.from_dict(other), other)
+                self.assertLessEqual(len(postcodes._AREAS), 10)
+
+        for lat, lng in (('51.520100', '-0.100000'), ('51.5201', '-0.1'), 
+                         ('51.52010000', '0')):
+            other = dict(data, geo=dict(data['geo'], lat=lat, lng=lng))
+            record = PostcodeRecord.from_dict(other)
+            self.assertEqual(record.to_dict(), other)
+            self.assertEqual(json.loads(json.dumps(record.to_dict())), other)
+        other = dict(data, geo=dict(data['geo'], lat=51.5201))
+        self.assertIs(PostcodeRecord.from_dict(other), other)
+
+        data['distance'] = '0.1'
+        self.assertEqual(PostcodeRecord.from_dict(data)['distance'], '0.1')
+        data['extra'] = 1
+        self.assertIs(PostcodeRecord.from_dict(data), data)
+        for data in (None, {}, {'geo': {}}, [1]):
+            self.assertIs(PostcodeRecord.from_dict(data), data)
+
+    def test_postcoder(self):
+        """ Tests PostCoder stores compact records """
+        server = StubServer().start()
+        tmp = tempfile.mkdtemp()
+        try:
+            with patch('postcodes.END_POINT', server.url):
+                pc = PostCoder(compact=True)
+                result = pc.get('SW1A 2TT')
+                self.assertIsInstance(result, PostcodeRecord)
+                self.assertIs(pc.get('SW1A 2TT'), result)
+                self.assertEqual(result, postcodes.get('SW1A 2TT'))
+                results = pc.get_from_geo(51.5, -0.13, 2)
+                self.assertTrue(all(isinstance(r, PostcodeRecord) 
+                                    for r in results))
+                self.assertEqual(len(pc.get_from_geo(51.5, -0.13, 0.5)), 2)
+                self.assertIsNone(pc.get('ZZ1 1ZZ'))
+                cache = SQLiteCache(os.path.join(tmp, 'cache.db'))
+                pc = PostCoder(cache=cache, compact=True)
+                self.assertEqual(pc.get('SW1A 2TT'), result)
+                self.assertEqual(cache[('sw1a2tt',)], result)
+        finally:
+            server.stop()
+            shutil.rmtree(tmp)
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.url = self.server.url + '/postcode/W1A1AA.json'
+        self.sleeps = []
+        self.patcher = patch('postcodes._sleep', self.sleeps.append)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.stop()
+
+    def test_retry(self):
+        """ Tests Transport retries failed requests """
+        retry = RetryPolicy(retries=3, backoff=0.5, max_backoff=1, 
+                            jitter=False)
+        transport = Transport(retry=retry)
+        self.server.failures.extend(['drop', 503, 500])
+        status, _ = transport.request(self.url)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.sleeps, [0.5, 1, 1])
+        self.assertEqual(transport.stats(), {
+            'requests': 1, 'attempts': 4, 'retries': 3, 'successes': 1, 
+            'failures': 0, 'short_circuits': 0})
+
+        self.server.failures.extend([503] * 4)
+        with patch('postcodes.END_POINT', self.server.url):
+            try:
+                postcodes.get('W1A 1AA', transport=transport)
+            except ServiceException as e:
+                self.assertEqual(e.status, 503)
+            else:
+                self.fail("ServiceException not raised")
+        self.assertEqual(transport.stats()['failures'], 1)
+        # 404s and other client errors aren't retried
+        self.server.failures.append(400)
+        self.assertEqual(transport.request(self.url)[0], 400)
+        self.assertEqual(transport.stats()['attempts'], 9)
+
+    def test_jitter(self):
+        """ Tests RetryPolicy randomises delays """
+        retry = RetryPolicy(backoff=1, max_backoff=3)
+        delays = [retry.delay(3) for _ in range(100)]
+        self.assertTrue(all(0 <= d <= 3 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    @patch('postcodes._now')
+    def test_deadline(self, now):
+        """ Tests Transport stops retrying at the deadline """
+        now.return_value = 0
+        transport = Transport(retry=RetryPolicy(retries=5, backoff=2, 
+                                                jitter=False, deadline=3))
+        self.server.failures.extend([503] * 6)
+        self.assertEqual(transport.request(self.url)[0], 503)
+        self.assertEqual(self.sleeps, [2])
+        # the deadline passes before an attempt is made
+        now.side_effect = [0, 5, 5]
+        self.assertRaises(ServiceException, transport.request, self.url)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_deadline_limiter(self):
+        """ Tests waiting for a limiter counts towards the deadline """
+        transport = Transport(retry=RetryPolicy(0, deadline=0.5), 
+                              limiter=RateLimiter(1, burst=1))
+        self.assertEqual(transport.request(self.url)[0], 200)
+        self.assertRaises(ServiceException, transport.request, self.url)
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(len(self.server.requests), 1)
+        transport.close()
+
+    @patch('postcodes._now')
+    def test_circuit_breaker(self, now):
+        """ Tests Transport fails fast while the breaker is open """
+        now.return_value = 0
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        transport = Transport(retry=RetryPolicy(0), breaker=breaker)
+        self.server.failures.extend([500, 500])
+        transport.request(self.url)
+        self.assertEqual(breaker.state, 'closed')
+        transport.request(self.url)
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenException, transport.request, self.url)
+        self.assertEqual(len(self.server.requests), 2)
+
+        now.return_value = 10
+        self.assertEqual(breaker.state, 'half-open')
+        self.server.failures.append(500) # the trial request fails
+        transport.request(self.url)
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenException, transport.request, self.url)
+        now.return_value = 20
+        self.assertEqual(transport.request(self.url)[0], 200)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(transport.stats()['short_circuits'], 2)
+
+    def test_circuit_breaker_errors(self):
+        """ Tests unexpected errors can't leave the breaker half-open """
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        transport = Transport(retry=RetryPolicy(0), breaker=breaker)
+        self.server.failures.extend(['corrupt', 'corrupt'])
+        self.assertRaises(ServiceException, transport.request, self.url)
+        self.assertEqual(breaker.state, 'half-open')
+        # the trial request's corrupt body is a failure like any other
+        self.assertRaises(ServiceException, transport.request, self.url)
+        with patch.object(transport, '_request', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, transport.request, self.url)
+        self.assertEqual(breaker.failures, 3)
+        self.assertEqual(transport.request(self.url)[0], 200)
+        self.assertEqual(breaker.state, 'closed')
+        self.server.failures.append('corrupt')
+        with patch('postcodes.END_POINT', self.server.url):
+            results = postcodes.get_from_geo(51.5, -0.13, 2, stream=True,
+                                             transport=transport)
+            self.assertRaises(ServiceException, list, results)
+
+    def test_stream_retry(self):
+        """ Tests streamed requests are retried """
+        transport = Transport(retry=RetryPolicy(jitter=False))
+        self.server.failures.extend([502, 502])
+        with patch('postcodes.END_POINT', self.server.url):
+            results = postcodes.get_from_geo(51.5, -0.13, 2, stream=True,
+                                             transport=transport)
+            self.assertEqual(len(list(results)), 5)
+        self.assertEqual(transport.stats()['retries'], 2)
+        self.assertEqual(self.server.connections, 1)
+
+
+class TestLimiters(unittest.TestCase):
+    @patch('postcodes._sleep')
+    @patch('postcodes._now')
+    def test_rate_limiter(self, now, sleep):
+        """ Tests RateLimiter's token bucket """
+        now.return_value = 0
+        limiter = RateLimiter(2, burst=3)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertFalse(sleep.called)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1.0])
+        # the waits were reserved, so after them the bucket is empty
+        now.return_value = 1
+        sleep.reset_mock()
+        limiter.acquire()
+        self.assertEqual(sleep.call_args[0][0], 0.5)
+        now.return_value = 100
+        sleep.reset_mock()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertFalse(sleep.called)
+        # a caller which can't wait long enough doesn't take a token
+        self.assertFalse(limiter.acquire(timeout=0.4))
+        self.assertTrue(limiter.acquire(timeout=0.5))
+        self.assertEqual(sleep.call_args[0][0], 0.5)
+        self.assertRaises(ValueError, RateLimiter, 0)
+
+    def test_adaptive_limiter(self):
+        """ Tests AdaptiveLimiter's AIMD limit """
+        limiter = AdaptiveLimiter(initial=2, max_limit=3, latency_target=1)
+        limiter.acquire()
+        limiter.acquire()
+        acquired = threading.Event()
+        def third():
+            limiter.acquire()
+            acquired.set()
+        thread = threading.Thread(target=third)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(0.1, True)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(limiter.limit, 2) # 2.5
+        limiter.release(0.1, True)
+        self.assertEqual(limiter.limit, 2) # 2.9
+        limiter.release(0.1, True)
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(0.1, True)
+        self.assertEqual(limiter.limit, 3)
+        limiter.acquire()
+        limiter.release(2, True) # slow
+        self.assertEqual(limiter.limit, 1)
+        limiter.acquire()
+        limiter.release(0.1, False)
+        self.assertEqual(limiter.limit, 1)
+        self.assertEqual(limiter.inflight, 0)
+        limiter.acquire()
+        self.assertFalse(limiter.acquire(timeout=0.05))
+        self.assertEqual(limiter.inflight, 1)
+
+    def test_transport(self):
+        """ Tests the default Transport's limiters apply to PostCoders """
+        server = StubServer().start()
+        limiter = RateLimiter(1000)
+        concurrency = AdaptiveLimiter(initial=1)
+        transport = Transport(limiter=limiter, concurrency=concurrency)
+        try:
+            with patch('postcodes.END_POINT', server.url), \
+                 patch('postcodes._default_transport'):
+                postcodes.set_default_transport(transport)
+                with patch.object(limiter, 'acquire', 
+                                  wraps=limiter.acquire) as acquire:
+                    PostCoder().get('SW1A 2TT')
+                    PostCoder().get('W1A 1AA')
+                    self.assertEqual(acquire.call_count, 2)
+            self.assertEqual(concurrency.inflight, 0)
+            self.assertGreater(concurrency._limit, 1)
+        finally:
+            transport.close()
+            server.stop()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.transport = Transport()
+        self.patcher = patch('postcodes.END_POINT', self.server.url)
+        self.patcher.start()
+        self.metrics = postcodes.enable_metrics()
+
+    def tearDown(self):
+        postcodes.disable_metrics()
+        self.patcher.stop()
+        self.transport.close()
+        self.server.stop()
+
+    def test_requests(self):
+        """ Tests latency, bytes and in-flight measurements """
+        events = []
+        self.metrics.add_hook(lambda *args: events.append(args))
+        coder = PostCoder(transport=self.transport)
+        coder.get('SW1A 2TT')
+        coder.get('SW1A 2TT')
+        coder.get('ZZ9 9ZZ')
+        coder.get('ZZ9 9ZZ')
+        coder.get_from_geo(51.5, -0.12, 1)
+        snapshot = self.metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(counters['cache.hits'], 1)
+        self.assertEqual(counters['cache.negative_hits'], 1)
+        self.assertEqual(counters['cache.misses'], 3)
+        self.assertEqual(counters['transport.requests'], 3)
+        self.assertGreater(counters['bytes.postcode'], 0)
+        self.assertGreater(counters['bytes.distance.php'], 0)
+        self.assertEqual(snapshot['gauges'], {'inflight.postcode': 0, 
+                                              'inflight.distance.php': 0})
+        latency = snapshot['histograms']['latency.postcode']
+        self.assertEqual(latency['count'], 2)
+        self.assertEqual(latency['buckets'][-1], (float('inf'), 2))
+        self.assertTrue(latency['min'] <= latency['max'] <= latency['sum'])
+        self.assertEqual(snapshot['histograms']['decode.postcode']['count'], 
+                         2)
+        self.assertIn(('gauge', 'inflight.postcode', 1), events)
+        self.assertIn(('count', 'cache.hits', 1), events)
+
+    def test_histogram(self):
+        """ Tests Metrics histogram buckets and reset """
+        metrics = Metrics(buckets=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            metrics.observe('x', value)
+        hist = metrics.snapshot()['histograms']['x']
+        self.assertEqual(hist['buckets'], 
+                         [(1, 2), (2, 3), (float('inf'), 4)])
+        self.assertEqual((hist['count'], hist['sum'], hist['min'], 
+                          hist['max']), (4, 6, 0.5, 3))
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), 
+                         {'counters': {}, 'gauges': {}, 'histograms': {}})
+
+    def test_evictions(self):
+        """ Tests cache evictions are counted """
+        cache = LRUCache(1)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(self.metrics.snapshot()['counters'], 
+                         {'cache.evictions': 1})
+
+    def test_disabled(self):
+        """ Tests nothing is measured once metrics are disabled """
+        postcodes.disable_metrics()
+        PostCoder(transport=self.transport).get('SW1A 2TT')
+        self.assertEqual(self.metrics.snapshot()['counters'], {})
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        csv_path = os.path.join(self.dir, 'onspd.csv')
+        write_csv(csv_path)
+        self.dataset = LocalDataset.build(csv_path, 
+                                          os.path.join(self.dir, 'index'))
+        self.server = postcodes.make_server(
+            port=0, coder=PostCoder(dataset=self.dataset))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.patcher = patch('postcodes.END_POINT', postcodes.END_POINT)
+        self.patcher.start()
+        postcodes.set_end_point('http://127.0.0.1:%s/' % 
+                                self.server.server_address[1])
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dataset.close()
+        shutil.rmtree(self.dir)
+
+    def test_lookups(self):
+        """ Tests the module functions via make_server """
+        self.assertEqual(postcodes.get('sw1a 2tt'), 
+                         self.dataset.get('SW1A 2TT'))
+        self.assertIsNone(postcodes.get('ZZ9 9ZZ'))
+        self.assertEqual(postcodes.get_nearest(51.5186, -0.1438), 
+                         self.dataset.get('W1A 1AA'))
+        self.assertEqual(postcodes.get_from_postcode('SW1A 2TT', 0.3),
+                         self.dataset.within_postcode('SW1A 2TT', 0.3))
+        # large enough to be compressed
+        self.assertEqual(postcodes.get_from_geo(51.5, -0.12, 5),
+                         self.dataset.within(51.5, -0.12, 5))
+        with self.assertRaises(ServiceException) as cm:
+            postcodes.get_nearest(91, 0)
+        self.assertEqual(cm.exception.status, 400)
+
+    def test_errors(self):
+        """ Tests make_server's responses when its PostCoder fails """
+        transport = Transport(retry=RetryPolicy(0))
+        coder = self.server.coder
+        for error, status in ((RuntimeError('boom'), 500), 
+                              (ServiceException('down'), 502)):
+            with patch.object(coder, 'get', side_effect=error):
+                with self.assertRaises(ServiceException) as cm:
+                    postcodes.get('SW1A 2TT', transport=transport)
+            self.assertEqual(cm.exception.status, status)
+        # the connection was kept open throughout
+        self.assertEqual(len(transport._pools), 1)
+        transport.close()
+        # bad responses from upstream aren't blamed on the client
+        self.assertRaises(ServiceException, postcodes._decode_json_resp, 
+                          'url', 200, b'{bad')
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = StubServer().start()
+        self.patcher = patch('postcodes.END_POINT', self.server.url)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def path(self, name, content=None):
+        path = os.path.join(self.dir, name)
+        if content is not None:
+            with open(path, 'w') as f:
+                f.write(content)
+        return path
+
+    def test_csv(self):
+        """ Tests the postcodes command with CSV files """
+        import csv
+        src = self.path('in.csv', 'id,postcode\n1,sw1a 2tt\n2,ZZ1 1ZZ\n'
+                                  '3,W1A 1AA\n4,\n')
+        out = self.path('out.csv')
+        cache = self.path('cache.db')
+        argv = [src, '-o', out, '--cache', cache, '--progress', '0']
+        self.assertEqual(postcodes.main(argv), 0)
+        with open(out) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([r['id'] for r in rows], ['1', '2', '3', '4'])
+        self.assertEqual(rows[0]['postcode'], 'sw1a 2tt')
+        self.assertEqual(rows[0]['lat'], '51.502308')
+        self.assertEqual(rows[0]['district'], 'Westminster')
+        self.assertEqual(rows[0]['error'], '')
+        self.assertEqual([r['error'] for r in rows[1:]], 
+                         ['not found', '', 'not found'])
+        # resuming after an interruption part way through the third row
+        with open(out) as f:
+            lines = f.readlines()
+        with open(out, 'w') as f:
+            f.writelines(lines[:3] + [lines[3][:10]])
+        del self.server.requests[:]
+        self.assertEqual(postcodes.main(argv + ['--resume']), 0)
+        with open(out) as f:
+            self.assertEqual(f.readlines(), lines)
+        self.assertEqual(self.server.requests, []) # the cache was used
+        # missing columns are reported before anything is written
+        with patch('sys.stderr'):
+            self.assertRaises(SystemExit, postcodes.main, 
+                              argv + ['--postcode-column', 'pc'])
+            self.assertRaises(SystemExit, postcodes.main, 
+                              argv + ['--lat-column', 'lat'])
+        with open(out) as f:
+            self.assertEqual(f.readlines(), lines)
+
+    def test_jsonl(self):
+        """ Tests the postcodes command with JSON lines of points """
+        src = self.path('in.jsonl', '{"lat": 51.5023, "lng": -0.1243}\n'
+                                    '{"lat": 100, "lng": 0}\n')
+        out = self.path('out.jsonl')
+        self.assertEqual(postcodes.main([src, '-o', out, '--lat-column', 
+                                         'lat', '-w', '2']), 0)
+        with open(out) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[0]['result']['postcode'], 'SW1A 2TT')
+        self.assertIsNone(rows[0]['error'])
+        self.assertIsNone(rows[1]['result'])
+        self.assertIn('Illegal', rows[1]['error'])
+
+    def test_jsonl_postcodes(self):
+        """ Tests the postcodes command with odd JSON lines of postcodes """
+        src = self.path('in.jsonl', '"SW1A 2TT"\n{"postcode": 12345}\n'
+                                    '{"postcode": null}\n[1]\n{bad json\n'
+                                    '"W1A 1AA"\n')
+        out = self.path('out.jsonl')
+        argv = [src, '-o', out, '--rate', '0']
+        self.assertEqual(postcodes.main(argv), 0)
+        with open(out) as f:
+            lines = f.readlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r['result'] and r['result']['postcode'] 
+                          for r in rows], 
+                         ['SW1A 2TT', None, None, None, None, 'W1A 1AA'])
+        self.assertEqual([r['error'] for r in rows[1:4]], ['not found'] * 3)
+        self.assertEqual(rows[4]['line'], '{bad json')
+        self.assertIn('invalid JSON', rows[4]['error'])
+        with open(out, 'w') as f:
+            f.writelines(lines[:5] + [lines[5][:10]])
+        self.assertEqual(postcodes.main(argv + ['--resume']), 0)
+        with open(out) as f:
+            self.assertEqual(f.readlines(), lines)
+
+    def test_completed_rows(self):
+        """ Tests partly written rows longer than a chunk are removed """
+        path = self.path('out.jsonl', '{}\n{}\n' + 'x' * 100000)
+        self.assertEqual(postcodes._completed_rows(path, 'jsonl'), 2)
+        self.assertEqual(os.path.getsize(path), 6)
+        path = self.path('out.jsonl', 'x' * 100000)
+        self.assertEqual(postcodes._completed_rows(path, 'jsonl'), 0)
+        self.assertEqual(os.path.getsize(path), 0)
+        self.assertEqual(postcodes._completed_rows(self.path('none'), 
+                                                   'jsonl'), 0)
 
 
+class TestImport(unittest.TestCase):
+    #: Seconds importing postcodes may take, including compiling it.
+    BUDGET = 0.25
 
+    def test_import_time(self):
+        """ Tests importing postcodes is quick and loads nothing slow """
+        code = ("import sys, time\n"
+                "before = set(sys.modules)\n"
+                "start = time.time()\n"
+                "import postcodes\n"
+                "print(time.time() - start)\n"
+                "print(' '.join(sorted(set(sys.modules) - before)))\n")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], 
+                                      cwd=root).decode('utf-8').split('\n')
+        self.assertLess(float(out[0]), self.BUDGET)
+        imported = set(out[1].split())
+        for name in ('json', 're', 'random', 'socket', 'ssl', 'http.client', 
+                     'httplib', 'urllib.parse', 'urlparse', 'email'):
+            self.assertNotIn(name, imported)
 
+    def test_fast_json(self):
+        """ Tests a faster JSON decoder is used when available """
+        orjson = types.ModuleType('orjson')
+        orjson.loads = lambda data: ['orjson', data]
+        with patch('postcodes._fast_loads', None), \
+                patch.dict(sys.modules, {'orjson': orjson}):
+            self.assertEqual(postcodes._decode_json_resp('url', 200, b'[1]'), 
+                             ['orjson', b'[1]'])
+        with patch('postcodes._fast_loads', None), \
+                patch.dict(sys.modules, {'orjson': None, 'ujson': None, 
+                                         'simplejson': None}):
+            self.assertEqual(postcodes._decode_json_resp(
+                'url', 200, u'["\u00a3"]'.encode('utf-8')), [u'\u00a3'])
@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+
+from mock import patch
+
+from postcodes import IllegalPointException, IllegalDistanceException, \
+                      ServiceException
+from postcodes_async import AsyncPostCoder
+
+from .server import StubServer
+
+
+class TestAsyncPostCoder(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer().start()
+        self.patcher = patch('postcodes.END_POINT', self.server.url)
+        self.patcher.start()
+        self.pc = AsyncPostCoder(max_concurrency=2)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.stop()
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_get(self):
+        """ Tests AsyncPostCoder.get """
+        async def lookups():
+            return await asyncio.gather(*[self.pc.get(p) for p in
+                                          ('SW1A 2TT', 'sw1a2tt', 'W1A1AA',
+                                           'ZZ1 1ZZ')])
+        results = self.run_async(lookups())
+        self.assertEqual([r and r['postcode'] for r in results],
+                         ['SW1A 2TT', 'SW1A 2TT', 'W1A 1AA', None])
+        # concurrent requests for the same postcode are coalesced
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIn(('sw1a2tt',), self.pc.cache)
+        # unknown postcodes are cached apart from the others
+        self.assertNotIn(('zz11zz',), self.pc.cache)
+        self.assertIn(('zz11zz',), self.pc.negative_cache)
+        self.assertIsNone(self.run_async(self.pc.get('ZZ1 1ZZ')))
+        self.assertEqual(len(self.server.requests), 3)
+        self.run_async(self.pc.get('SW1A2TT'))
+        self.assertEqual(len(self.server.requests), 3)
+        self.run_async(self.pc.get('SW1A2TT', skip_cache=True))
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_get_nearest(self):
+        """ Tests AsyncPostCoder.get_nearest """
+        result = self.run_async(self.pc.get_nearest('51.5185', -0.1437))
+        self.assertEqual(result['postcode'], 'W1A 1AA')
+        self.assertIn((51.5185, -0.1437), self.pc.cache)
+        self.assertRaises(IllegalPointException, self.run_async,
+                          self.pc.get_nearest(-91, 0))
+
+    def test_get_from(self):
+        """ Tests AsyncPostCoder.get_from_postcode and get_from_geo """
+        results = self.run_async(self.pc.get_from_postcode('SW1A 2TT', 0.2))
+        self.assertEqual([r['postcode'] for r in results],
+                         ['SW1A 2TT', 'SW1A 2AA'])
+        results = self.run_async(self.pc.get_from_geo(51.5, -0.13, 2))
+        self.assertEqual(len(results), 5)
+        self.assertIn(('sw1a2tt', 0.2), self.pc.cache)
+        self.assertIn((51.5, -0.13, 2.0), self.pc.cache)
+        self.assertRaises(IllegalDistanceException, self.run_async,
+                          self.pc.get_from_geo(0, 0, -1))
+
+    def test_corrupt(self):
+        """ Tests AsyncPostCoder raises ServiceException for bad gzip """
+        self.server.failures.append('corrupt')
+        self.assertRaises(ServiceException, self.run_async,
+                          self.pc.get('W1A 1AA'))
+
+    def test_unavailable(self):
+        """ Tests AsyncPostCoder raises ServiceException """
+        self.server.stop()
+        self.assertRaises(ServiceException, self.run_async,
+                          self.pc.get('W1A 1AA'))
+        self.server = StubServer().start()